@@ -0,0 +1,42 @@
+#!/bin/bash
+
+# launch an Exelixi Executor from a content-addressed bundle, which
+# gets cached on each slave: repeat launches of the same version skip
+# both the download and the unpacking
+#
+# usage: launch_bundle.sh <bundle URI> <digest> <cache dir>
+
+URI=$1
+DIGEST=$2
+CACHE=${3:-/tmp/exelixi/cache}
+DIR=$CACHE/$DIGEST
+
+if [ ! -f $DIR/.complete ]
+then
+  echo "fetching bundle $DIGEST from $URI"
+  mkdir -p $CACHE
+  TMP=`mktemp -d $CACHE/fetch.XXXXXX`
+
+  case $URI in
+    hdfs://*) hadoop fs -get $URI $TMP/bundle.tgz ;;
+    file://*) cp ${URI#file://} $TMP/bundle.tgz ;;
+    *) curl -sf -o $TMP/bundle.tgz $URI ;;
+  esac
+
+  # the digest is the SHA-224 of the tarball, so verify before unpacking
+  if ! echo "$DIGEST  $TMP/bundle.tgz" | sha224sum -c --status 2>/dev/null
+  then
+    echo "bundle digest mismatch for $URI" 1>&2
+    rm -rf $TMP
+    exit 1
+  fi
+
+  tar xzf $TMP/bundle.tgz -C $TMP
+  rm -f $TMP/bundle.tgz
+  touch $TMP/.complete
+
+  # NB: another Executor on this slave may have won the race
+  mv -T $TMP $DIR 2>/dev/null || rm -rf $TMP
+fi
+
+exec $DIR/src/exelixi.py
@@ -8,6 +8,7 @@ sudo aptitude -y install python-setuptools
 sudo aptitude -y install python-protobuf
 sudo aptitude -y install python-gevent
 sudo aptitude -y install python-psutil 
+sudo aptitude -y install python-numpy
 sudo aptitude -y install python-dev
 sudo aptitude -y install python-pip
 
@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# author: Paco Nathan
+# https://github.com/ceteri/exelixi
+
+
+
+from base64 import b64decode, b64encode
+from collections import Counter, deque
+from heapq import heappush, heapreplace
+from math import ceil, exp, log
+import sys
+
+
+######################################################################
+## class definitions
+
+class BloomFilter (object):
+    """compact summary of a set of keys which are hex digests, e.g., Individual.key; a lookup may return a false positive, but never a false negative"""
+
+    def __init__ (self, capacity, fp_rate=0.01):
+        self.capacity = capacity
+        self.fp_rate = fp_rate
+        self.count = 0
+
+        # optimal sizing for the given capacity and false positive rate
+        self.n_bits = int(ceil(-capacity * log(fp_rate) / (log(2.0) ** 2.0)))
+        self.n_hashes = max(1, int(round(self.n_bits * log(2.0) / capacity)))
+        self._bits = bytearray((self.n_bits + 7) / 8)
+
+
+    def _get_indexes (self, key):
+        """bit indexes for a key, by double hashing on slices of its digest"""
+        h1 = int(key[:16], 16)
+        h2 = int(key[16:32], 16) | 1
+
+        return [ (h1 + i * h2) % self.n_bits for i in xrange(self.n_hashes) ]
+
+
+    def add (self, key):
+        """add a key to the set"""
+        for i in self._get_indexes(key):
+            self._bits[i >> 3] |= 1 << (i & 7)
+
+        self.count += 1
+
+
+    def __contains__ (self, key):
+        for i in self._get_indexes(key):
+            if not self._bits[i >> 3] & (1 << (i & 7)):
+                return False
+
+        return True
+
+
+    def is_full (self):
+        """test whether the set has reached its capacity, beyond which false positives exceed the target rate"""
+        return self.count >= self.capacity
+
+
+    def get_fp_rate (self):
+        """estimated false positive rate, given the number of keys added"""
+        return (1.0 - exp(-float(self.n_hashes * self.count) / self.n_bits)) ** self.n_hashes
+
+
+    def get_msg (self):
+        """serialize, e.g., to publish to peer shards"""
+        return { "capacity": self.capacity, "fp_rate": self.fp_rate, "count": self.count, "bits": b64encode(self._bits) }
+
+
+class AgingBloomFilter (object):
+    """set of hex digest keys within a fixed memory budget: a rotating series of Bloom filters, where the keys in the oldest one expire once the newest one fills"""
+
+    ## NB: estimated bytes per key held in the audit sample
+    SAMPLE_KEY_BYTES = 192
+
+
+    def __init__ (self, budget, fp_rate=0.001, n_slices=4, audit_share=0.125):
+        # NB: the audit sample gets its share of the budget (bytes),
+        # unless that's too small to hold any keys, then each slice gets
+        # sized to fit its share of the rest
+        overhead = sys.getsizeof(set()) + sys.getsizeof([])
+        self.sample_size = max(0, int((budget * audit_share - overhead) / self.SAMPLE_KEY_BYTES))
+
+        if self.sample_size == 0:
+            audit_share = 0.0
+
+        slice_budget = budget * (1.0 - audit_share) / n_slices
+
+        self.slice_capacity = max(1, int(slice_budget * 8.0 * (log(2.0) ** 2.0) / -log(fp_rate)))
+        self.fp_rate = fp_rate
+        self.n_slices = n_slices
+
+        self._slices = deque([ BloomFilter(self.slice_capacity, fp_rate) ])
+        self.expired = 0
+
+        # NB: an exact bottom-k sample of all the keys ever added, i.e.,
+        # those with the smallest hash values, measures the duplicates
+        # rediscovered after their keys expired, and the novel keys
+        # rejected as false positives; any key which hashes at or below
+        # the largest value in the sample is in it iff it was added
+        self._sample = set()
+        self._sample_heap = []
+        self._stats = Counter()
+
+
+    def _get_sample_hash (self, key):
+        """hash a key for the audit sample, from the end of its digest, which the slices index least"""
+        return int(key[-15:], 16)
+
+
+    def _is_sampled (self, h):
+        """test whether a hashed key falls within the scope of the audit sample"""
+        if self.sample_size == 0:
+            return False
+
+        return len(self._sample_heap) < self.sample_size or h <= -self._sample_heap[0]
+
+
+    def __contains__ (self, key):
+        found = any([ key in bloom for bloom in self._slices ])
+        h = self._get_sample_hash(key)
+
+        if self._is_sampled(h):
+            self._stats["sampled"] += 1
+
+            if not found and h in self._sample:
+                self._stats["rediscovered"] += 1
+            elif found and h not in self._sample:
+                self._stats["false_positives"] += 1
+
+        return found
+
+
+    def _add_sample (self, h):
+        """add a hashed key to the audit sample, displacing the largest one once the sample is full"""
+        if self.sample_size == 0 or h in self._sample:
+            return
+        elif len(self._sample_heap) < self.sample_size:
+            heappush(self._sample_heap, -h)
+            self._sample.add(h)
+        elif h < -self._sample_heap[0]:
+            self._sample.discard(-heapreplace(self._sample_heap, -h))
+            self._sample.add(h)
+
+
+    def add (self, key):
+        """add a key to the newest slice, rotating out the oldest slice whenever the newest one fills"""
+        if self._slices[-1].is_full():
+            self._slices.append(BloomFilter(self.slice_capacity, self.fp_rate))
+
+            if len(self._slices) > self.n_slices:
+                self.expired += self._slices.popleft().count
+
+        self._slices[-1].add(key)
+        self._add_sample(self._get_sample_hash(key))
+
+
+    def get_memory (self):
+        """bytes used by the slices plus the audit sample, if any"""
+        n_bytes = sum([ len(bloom._bits) for bloom in self._slices ])
+
+        if self.sample_size > 0:
+            n_bytes += sys.getsizeof(self._sample) + sys.getsizeof(self._sample_heap)
+            n_bytes += sum([ sys.getsizeof(h) for h in self._sample ]) + sum([ sys.getsizeof(h) for h in self._sample_heap ])
+
+        return n_bytes
+
+
+    def get_count (self):
+        """number of keys currently held, i.e., not yet expired"""
+        return sum([ bloom.count for bloom in self._slices ])
+
+
+    def get_slices (self):
+        """the Bloom filters which currently hold the keys, e.g., to publish to peer shards"""
+        return list(self._slices)
+
+
+    def get_fp_rate (self):
+        """estimated false positive rate across all of the slices"""
+        return get_union_fp_rate(self._slices)
+
+
+    def get_report (self):
+        """summarize then reset the audit stats: the number of sampled lookups, then the fractions of them which were rediscovered duplicates or false positives"""
+        stats = self._stats
+        self._stats = Counter()
+
+        n = float(max(stats["sampled"], 1))
+        return stats["sampled"], stats["rediscovered"] / n, stats["false_positives"] / n
+
+
+######################################################################
+## utility functions
+
+def get_union_fp_rate (blooms):
+    """estimated false positive rate for a lookup which tests each of the given Bloom filters"""
+    p = 1.0
+
+    for bloom in blooms:
+        p *= 1.0 - bloom.get_fp_rate()
+
+    return 1.0 - p
+
+
+def load_bloom (msg):
+    """deserialize a BloomFilter published by a peer shard"""
+    bloom = BloomFilter(msg["capacity"], msg["fp_rate"])
+    bloom.count = msg["count"]
+    bloom._bits = bytearray(b64decode(msg["bits"]))
+    return bloom
+
+
+if __name__=='__main__':
+    # a simple test: measure the false positive rate at capacity
+    from hashlib import sha224
+
+    bloom = BloomFilter(10000, 0.01)
+
+    for i in xrange(bloom.capacity):
+        bloom.add(sha224(str(i)).hexdigest())
+
+    bloom = load_bloom(bloom.get_msg())
+    assert all([ sha224(str(i)).hexdigest() in bloom for i in xrange(bloom.capacity) ])
+
+    n = 100000
+    fp = sum([ 1 for i in xrange(n) if sha224("x" + str(i)).hexdigest() in bloom ])
+
+    print "%d bytes, %d hashes: measured fp rate %0.4f, estimated %0.4f" % (len(bloom._bits), bloom.n_hashes, fp / float(n), bloom.get_fp_rate())
+
+    # then the memory vs. rediscovered duplicates tradeoff, for a
+    # stream of novel keys where each one recurs after a random delay
+    from heapq import heappop
+    from random import expovariate
+
+    for budget in [ 4096, 16384, 65536 ]:
+        aging = AgingBloomFilter(budget)
+        recurring = []
+
+        for i in xrange(50000):
+            key = sha224(str(i)).hexdigest()
+
+            if key not in aging:
+                aging.add(key)
+
+            heappush(recurring, (i + int(expovariate(1.0 / 5000.0)), key))
+
+            while recurring[0][0] <= i:
+                t, key = heappop(recurring)
+
+                if key not in aging:
+                    aging.add(key)
+
+        sampled, rediscovered, false_positives = aging.get_report()
+        print "budget %d bytes, using %d: %d keys held, %d expired; of %d sampled lookups, %0.4f rediscovered, %0.4f false positives" % (budget, aging.get_memory(), aging.get_count(), aging.expired, sampled, rediscovered, false_positives)
@@ -1,12 +1,17 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
-from collections import namedtuple
-from gevent import Greenlet
+from collections import deque, namedtuple
+from gevent import joinall, sleep, spawn, Greenlet
 from json import dumps, loads
-from os.path import abspath
+from logs import Sampler
+from memo import ResultStore
+from os.path import abspath, exists
 from service import UnitOfWork
+from tempfile import TemporaryFile
+from time import time
 from uow import UnitOfWorkFactory
+from util import get_file_fingerprint
 import logging
 import sys
 
@@ -25,14 +30,54 @@ class Container (object):
         self.file_name = abspath('dat/foo.tsv')
         ## NB: override to define the fields of a result tuple
         self.Result = namedtuple('Foo', ['bar', 'ugh'])
+        ## NB: override to write the results to a file, rather than stdout
+        self.out_file = None
+        ## NB: override to memoize run_calc results across runs, in a
+        ## local directory capped at memo_bytes -- clear it whenever
+        ## run_calc changes
+        self.memo_dir = None
+        self.memo_bytes = 256 * 1024 * 1024
+
+        ## NB: override to partition the data file across the shards
+        self.n_partitions = None
+
+        # columnar, memory-mapped view of the data file (optional)
+        self.dataset = None
+        self.partitions = {}
 
 
     def data_load (self, file_name):
         """load the specified data file"""
-        ## NB: override to load the data file
+        ## NB: override to load the data file, e.g., via load_dataset()
         self.param_space.append(23)
 
 
+    def data_load_partitions (self, file_name, partitions):
+        """load only the given partitions of the data file, i.e., those which the HashRing assigns to this shard"""
+        ## NB: override to load a subset of the data file, e.g., via load_dataset()
+        self.data_load(file_name)
+
+
+    def get_partition (self, params):
+        """determine which partition of the data file the given param space element touches"""
+        ## NB: override when the data file is partitioned
+        return 0
+
+
+    def load_dataset (self, file_name, fields=None, partitions=None):
+        """load the data file as memory-mapped columns, converted once and then shared by every process on this host"""
+        # NB: numpy is only required by the Container jobs which use this
+        from dataset import Dataset
+
+        self.dataset = Dataset(file_name, fields)
+
+        if partitions is not None:
+            # only the pages for these partitions ever get touched
+            self.partitions = { part: self.dataset.get_partition(part, self.n_partitions) for part in partitions }
+
+        return self.dataset
+
+
     def run_calc (self, params):
         """run calculations based on the given param space element"""
         ## NB: override to calculate a job
@@ -52,54 +97,283 @@ class ContainerUOWFactory (UnitOfWorkFactory):
 
 class ContainerUOW (UnitOfWork):
     """UnitOfWork definition for distrib Py jobs"""
+
+    ## NB: override to tune how shards pull chunks of the param space
+    CHUNK_SECONDS = 2.0
+    MAX_CHUNK = 1000
+    RATE_DECAY = 0.5
+    ## NB: override to tune how many results get paged per shard/dump
+    DUMP_PAGE = 1000
+    ## NB: override to tune when idle shards speculatively re-run the
+    ## oldest in-flight chunk (seconds), or None to disable
+    SPECULATE_AGE = 2.0 * CHUNK_SECONDS
+    SPECULATE_POLL = 0.5
+    YIELD_SECONDS = 0.05
+    ## NB: override to log more (or fewer) of the tasks at DEBUG level
+    LOG_SAMPLE = 100
+
+
     def __init__ (self, uow_name, prefix, container):
         super(ContainerUOW, self).__init__(uow_name, prefix)
         self._shard = {}
 
         self._container = container
-        self.results = []
+
+        # results spill to an on-disk NDJSON buffer on each shard
+        self._results_file = None
+        self.results_count = 0
+
+        # optional memo of results, keyed by params + data fingerprint
+        self._memo = None
+        self._fingerprint = None
+        self.memo_hits = 0
+
+        # tasks cancelled on this shard, since some other shard won
+        self._cancelled = set()
+        self._done = set()
+        self._dropped = 0
+
+        # deques of (task_id, params) and the in-flight chunks, held on
+        # the Framework
+        self._param_deque = None
+        self._in_flight = {}
+        self._speculated = set()
+        self._task_owner = {}
+        self.speculated_count = 0
+
+        self._log_sampler = Sampler(self.LOG_SAMPLE)
 
 
     def perform_task (self, payload):
         """perform a task consumed from the Worker.task_queue"""
-        logging.debug(payload)
+        log_task = logging.getLogger().isEnabledFor(logging.DEBUG) and self._log_sampler.ready()
+
+        if log_task:
+            logging.debug("task %s (1 in %d sampled)", payload, self.LOG_SAMPLE)
 
         if "job" in payload:
-            result = self._container.run_calc(payload["job"])
-            self.results.append(result)
-            logging.debug(result)
+            result = None
+
+            if self._memo:
+                key = self._memo.get_key(self._fingerprint, payload["job"])
+                result = self._memo.get(key)
+
+            if result is None:
+                result = dumps(self._container.run_calc(payload["job"]))
+
+                if self._memo:
+                    self._memo.put(key, result)
+
+            self._write_result(payload["id"], result)
+            self._done.add(payload["id"])
+
+            if log_task:
+                logging.debug("result %s", result)
         elif "nop" in payload:
             pass
 
 
+    def _write_result (self, task_id, result):
+        """append a result (as a JSON string) to the results buffer, tagged by its task id"""
+        self._results_file.write("[%s, %s]\n" % (dumps(task_id), result))
+        self.results_count += 1
+
+
     def orchestrate (self, framework):
         """initialize shards, then iterate until all percentiles are trained"""
+        self.load_shards(framework)
+
+        self.distribute_params(framework)
+        framework.phase_barrier()
+
+        if self._container.memo_dir:
+            n_calc = len(self._container.param_space)
+            hit_rate = self.memo_hits / float(n_calc) if n_calc > 0 else 0.0
+            logging.info("memo hits %d out of %d calculations, hit rate %0.4f", self.memo_hits, n_calc, hit_rate)
+
+        logging.info("speculatively re-ran %d straggler chunks", self.speculated_count)
+
+        self.report_results(framework)
+
+
+    def load_shards (self, framework):
+        """initialize the shards, then load the data on each shard and on the Framework"""
         framework.send_ring_rest("shard/init", {})
         framework.send_ring_rest("data/load", { "file": self._container.file_name })
 
         self._container.data_load(self._container.file_name)
         framework.phase_barrier()
 
-        while len(self._container.param_space) > 0:
-            for shard_id, shard_uri in framework.get_worker_list():
-                if len(self._container.param_space) > 0:
-                    params = self._container.param_space.pop(0)
-                    framework.send_worker_rest(shard_id, shard_uri, "calc/run", { "params": params })
 
-        framework.phase_barrier()
+    def distribute_params (self, framework):
+        """run each element of the param space on some shard"""
+        if self._container.n_partitions:
+            # send each param only to the shard which holds the data
+            # partition that it touches
+            self.set_ring(None, dict(framework.get_worker_list()), framework.ring_weights)
+            shard_deque = { shard_id: deque() for shard_id, shard_uri in framework.get_worker_list() }
+
+            for task_id, params in enumerate(self._container.param_space):
+                part = self._container.get_partition(params)
+                shard_deque[self._hash_ring.get_node(self._get_part_key(part))].append((task_id, params))
+
+            feeders = [ spawn(self._feed_shard, framework, shard_id, shard_uri, shard_deque[shard_id], 1) for shard_id, shard_uri in framework.get_worker_list() ]
+        else:
+            # each shard pulls chunks from the shared deque as soon as
+            # it goes idle, so that faster shards steal the remaining work
+            self._param_deque = deque(enumerate(self._container.param_space))
+            n_shard = framework.get_worker_count()
+            feeders = [ spawn(self._feed_shard, framework, shard_id, shard_uri, self._param_deque, n_shard) for shard_id, shard_uri in framework.get_worker_list() ]
+
+        joinall(feeders, raise_error=True)
+
+
+    def report_results (self, framework):
+        """report the results"""
+        if self._container.out_file:
+            with open(self._container.out_file, "w") as f:
+                self._merge_results(framework, f)
+        else:
+            self._merge_results(framework, sys.stdout)
+
+
+    def _merge_results (self, framework, f):
+        """merge the result streams from each shard into the output, one page at a time"""
+        f.write("\t".join(self._container.Result._fields) + "\n")
+
+        for shard_id, shard_uri in framework.get_worker_list():
+            offset = 0
+
+            while offset is not None:
+                lines = framework.send_worker_rest(shard_id, shard_uri, "shard/dump", { "offset": offset, "limit": self.DUMP_PAGE })
+                offset = loads(lines[0])["next"]
+
+                for line in lines[1:]:
+                    task_id, result = loads(line)
+                    f.write("\t".join(map(lambda x: x.encode("utf-8") if isinstance(x, unicode) else str(x), result)) + "\n")
+
+
+    def _get_part_key (self, part):
+        """key used to place a data partition on the HashRing"""
+        return "part/" + str(part)
+
+
+    def get_local_partitions (self):
+        """list the data partitions which the HashRing assigns to this shard"""
+        return [ part for part in xrange(self._container.n_partitions) if self._hash_ring.get_node(self._get_part_key(part)) == self._shard_id ]
+
+
+    def _feed_shard (self, framework, shard_id, shard_uri, param_deque, n_sharing):
+        """pull chunks of params from a deque on behalf of one shard, until the deque empties, then speculate on stragglers"""
+        rate = None
 
-        # report the results
-        needs_header = True
+        while True:
+            if len(param_deque) > 0:
+                chunk_size = self._get_chunk_size(rate, param_deque, n_sharing)
+                chunk = [ param_deque.popleft() for _ in xrange(min(chunk_size, len(param_deque))) ]
+            elif n_sharing > 1 and self.SPECULATE_AGE:
+                # NB: only when the data is not partitioned, since
+                # otherwise other shards would not hold the data
+                chunk = self._get_straggler(shard_id)
 
-        for shard_msg in framework.send_ring_rest("shard/dump", {}):
-            payload = loads(shard_msg)
+                if chunk:
+                    self.speculated_count += 1
+                    logging.info("shard %s speculatively re-running chunk %s", shard_id, chunk[0][0])
+                elif len(self._in_flight) > 0:
+                    sleep(self.SPECULATE_POLL)
+                    continue
+                else:
+                    break
+            else:
+                break
 
-            if needs_header:
-                print "\t".join(payload["fields"])
-                needs_header = False
+            self._in_flight[shard_id] = (time(), chunk)
 
-            for result in payload["results"]:
-                print "\t".join(map(lambda x: str(x), result))
+            try:
+                lines = framework.send_worker_rest(shard_id, shard_uri, "calc/run", { "chunk": chunk })
+            finally:
+                del self._in_flight[shard_id]
+
+            payload = loads(lines[0])
+            self._claim_tasks(framework, shard_id, payload["done"], payload["hits"])
+
+            # track the observed throughput as a moving average
+            chunk_rate = payload["count"] / max(payload["elapsed"], 1.0e-3)
+
+            if rate:
+                rate = self.RATE_DECAY * rate + (1.0 - self.RATE_DECAY) * chunk_rate
+            else:
+                rate = chunk_rate
+
+            logging.debug("shard %s chunk %d rate %.2f/sec", shard_id, len(chunk), rate)
+
+
+    def _get_straggler (self, shard_id):
+        """find the oldest chunk in flight on some other shard, if it is old enough to re-run speculatively"""
+        now = time()
+        straggler = None
+        max_age = self.SPECULATE_AGE
+
+        for other_id, (t0, chunk) in self._in_flight.items():
+            chunk_id = chunk[0][0]
+
+            if other_id != shard_id and chunk_id not in self._speculated and (now - t0) > max_age:
+                straggler = chunk
+                max_age = now - t0
+
+        if straggler:
+            self._speculated.add(straggler[0][0])
+            return [ (task_id, params) for task_id, params in straggler if task_id not in self._task_owner ]
+        else:
+            return None
+
+
+    def _claim_tasks (self, framework, shard_id, done, hits):
+        """the first shard to finish a task owns its result, and any other copies get cancelled; counts the memo hits among the tasks won"""
+        shard_dict = dict(framework.get_worker_list())
+        lost = []
+        won = set()
+
+        for task_id in done:
+            if task_id in self._task_owner:
+                lost.append(task_id)
+            else:
+                self._task_owner[task_id] = shard_id
+                won.add(task_id)
+
+        # NB: only the winning copy of each task counts, so that
+        # speculative re-runs do not inflate the hit rate
+        self.memo_hits += len(won.intersection(hits))
+
+        if len(lost) > 0:
+            # drop the duplicate results on this shard
+            framework.send_worker_rest(shard_id, shard_dict[shard_id], "calc/cancel", { "tasks": lost })
+
+        if len(won) > 0:
+            for other_id, (t0, chunk) in self._in_flight.items():
+                if other_id != shard_id:
+                    dupes = [ task_id for task_id, params in chunk if task_id in won ]
+
+                    if len(dupes) > 0:
+                        framework.send_worker_rest(other_id, shard_dict[other_id], "calc/cancel", { "tasks": dupes })
+
+
+    def _get_chunk_size (self, rate, param_deque, n_sharing):
+        """size the next chunk based on a shard's observed throughput, tapering off as a shared deque drains"""
+        if not rate:
+            # probe with a single calculation first
+            return 1
+
+        chunk_size = int(rate * self.CHUNK_SECONDS)
+
+        # guided self-scheduling: never take more than a fair share of
+        # the remaining work, so the last chunks balance out
+        if n_sharing > 1:
+            fair_share = len(param_deque) / (2 * n_sharing)
+        else:
+            fair_share = len(param_deque)
+
+        return max(1, min(chunk_size, fair_share, self.MAX_CHUNK))
 
 
     def handle_endpoints (self, worker, uri_path, env, start_response, body):
@@ -113,9 +387,13 @@ class ContainerUOW (UnitOfWork):
             Greenlet(self.data_load, worker, env, start_response, body).start()
             return True
         elif uri_path == '/calc/run':
-            # run the calculations
+            # run a chunk of calculations
             Greenlet(self.calc_run, worker, env, start_response, body).start()
             return True
+        elif uri_path == '/calc/cancel':
+            # cancel tasks which some other shard finished first
+            Greenlet(self.calc_cancel, worker, env, start_response, body).start()
+            return True
         elif uri_path == '/shard/dump':
             # dump the results
             Greenlet(self.shard_dump, worker, env, start_response, body).start()
@@ -133,9 +411,15 @@ class ContainerUOW (UnitOfWork):
         payload, start_response, body = worker.get_response_context(args[1:])
 
         if worker.auth_request(payload, start_response, body):
-            self.set_ring(worker.shard_id, worker.ring)
+            self.set_ring(worker.shard_id, worker.ring, worker.ring_weights)
             worker.prep_task_queue()
 
+            # anonymous file, removed once the worker service exits
+            self._results_file = TemporaryFile(prefix="exelixi-", suffix=".ndjson")
+
+            if self._container.memo_dir:
+                self._memo = ResultStore(self._container.memo_dir, self._container.memo_bytes)
+
             start_response('200 OK', [('Content-Type', 'text/plain')])
             body.put("Bokay\r\n")
             body.put(StopIteration)
@@ -153,43 +437,126 @@ class ContainerUOW (UnitOfWork):
                 body.put("Bokay\r\n")
                 body.put(StopIteration)
 
-                # load the data file
+                # load the data file, or only the partitions assigned to this shard
                 logging.debug(payload["file"])
-                self._container.data_load(payload["file"])
+
+                if self._container.n_partitions:
+                    partitions = self.get_local_partitions()
+                    logging.info("shard %s loading partitions %s", self._shard_id, partitions)
+                    self._container.data_load_partitions(payload["file"], partitions)
+                else:
+                    self._container.data_load(payload["file"])
+
+                if self._memo and exists(payload["file"]):
+                    self._fingerprint = get_file_fingerprint(payload["file"])
+                elif self._memo:
+                    # NB: this Container does not read a data file
+                    self._fingerprint = payload["file"]
 
                 # put a NOP into the queue, so we'll have something to join on
                 worker.put_task_queue({ "nop": True })
 
 
     def calc_run (self, *args, **kwargs):
-        """enqueue one calculation"""
+        """run a chunk of calculations, then report the elapsed time so the Framework can size the next chunk"""
         worker = args[0]
         payload, start_response, body = worker.get_response_context(args[1:])
 
         if worker.auth_request(payload, start_response, body):
             with worker.wrap_task_event():
+                t0 = time()
+                done = []
+                hits = []
+                t_yield = t0
+
+                for task_id, params in payload["chunk"]:
+                    if task_id not in self._cancelled:
+                        n_hits = self._memo.hits if self._memo else 0
+                        self.perform_task({ "job": params, "id": task_id })
+                        done.append(task_id)
+
+                        if self._memo and self._memo.hits > n_hits:
+                            hits.append(task_id)
+
+                    # NB: yield between calculations now and then, so
+                    # that a calc/cancel can get handled
+                    if time() - t_yield > self.YIELD_SECONDS:
+                        sleep(0.001)
+                        t_yield = time()
+
+                if self._memo:
+                    logging.debug("shard %s memo hit rate %0.4f", self._shard_id, self._memo.get_hit_rate())
+
                 # caller expects JSON response
                 start_response('200 OK', [('Content-Type', 'application/json')])
-                body.put(dumps({ "ok": 1 }))
+                body.put(dumps({ "count": len(done), "done": done, "hits": hits, "elapsed": time() - t0 }))
                 body.put("\r\n")
                 body.put(StopIteration)
 
-                # put the params into the queue
-                worker.put_task_queue({ "job": payload["params"] })
+
+    def calc_cancel (self, *args, **kwargs):
+        """cancel tasks which some other shard finished first, dropping any duplicate results"""
+        worker = args[0]
+        payload, start_response, body = worker.get_response_context(args[1:])
+
+        if worker.auth_request(payload, start_response, body):
+            tasks = set(payload["tasks"])
+            # NB: a shard may get cancelled twice for the same tasks,
+            # so count only the results not already dropped
+            self._dropped += len((tasks & self._done) - self._cancelled)
+            self._cancelled.update(tasks)
+
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            body.put("Bokay\r\n")
+            body.put(StopIteration)
 
 
     def shard_dump (self, *args, **kwargs):
-        """dump the results"""
+        """dump one page of the results as NDJSON, following a header line with the offset of the next page"""
         worker = args[0]
         payload, start_response, body = worker.get_response_context(args[1:])
 
         if worker.auth_request(payload, start_response, body):
-            start_response('200 OK', [('Content-Type', 'application/json')])
-            body.put(dumps({ "fields": self.results[0]._fields, "results": self.results }))
+            lines = self._read_results(payload["offset"], payload["limit"])
+
+            if len(lines) < payload["limit"]:
+                next_offset = None
+            else:
+                next_offset = payload["offset"] + sum(map(len, lines))
+
+            start_response('200 OK', [('Content-Type', 'application/x-ndjson')])
+            body.put(dumps({ "fields": self._container.Result._fields, "count": self.results_count - self._dropped, "next": next_offset }))
             body.put("\r\n")
+
+            for line in lines:
+                # dedup by task id: skip results which another shard won
+                if len(self._cancelled) == 0 or loads(line)[0] not in self._cancelled:
+                    body.put(line)
+
             body.put(StopIteration)
 
 
+    def _read_results (self, offset, limit):
+        """read up to limit lines from the results buffer, starting at the given byte offset"""
+        f = self._results_file
+        f.flush()
+        f.seek(offset)
+
+        lines = []
+
+        while len(lines) < limit:
+            line = f.readline()
+
+            if not line:
+                break
+
+            lines.append(line)
+
+        # NB: return to the end, so that further results get appended
+        f.seek(0, 2)
+        return lines
+
+
 if __name__=='__main__':
     ## test GA in standalone-mode, without distributed services
     pass
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# author: Paco Nathan
+# https://github.com/ceteri/exelixi
+
+
+from json import dumps, loads
+from numpy.lib.format import open_memmap
+from os.path import abspath, exists, join
+from tempfile import mkdtemp
+from util import get_file_fingerprint
+import logging
+import numpy as np
+import os
+import shutil
+import sys
+
+
+######################################################################
+## class definitions
+
+class Dataset (object):
+    """columnar view of a TSV data file, memory-mapped read-only from a binary cache shared by every process on a host"""
+
+    CACHE_DIR = "/tmp/exelixi/data"
+
+
+    def __init__ (self, file_name, fields=None, cache_dir=CACHE_DIR):
+        self.file_name = abspath(file_name)
+        self.fingerprint = get_file_fingerprint(self.file_name)
+        self.path = join(cache_dir, self.fingerprint)
+
+        # convert the TSV only once per host, for any given version of the file
+        if not exists(join(self.path, "meta.json")):
+            self._convert(cache_dir, fields)
+
+        with open(join(self.path, "meta.json"), "r") as f:
+            meta = loads(f.read())
+
+        self.fields = meta["fields"]
+        self.n_rows = meta["n_rows"]
+
+        # NB: read-only memory maps, so that the OS page cache gets
+        # shared and slices are zero-copy views
+        self.columns = [ np.load(join(self.path, "col_%d.npy" % i), mmap_mode="r") for i in xrange(len(self.fields)) ]
+
+
+    def __len__ (self):
+        return self.n_rows
+
+
+    def __getitem__ (self, field):
+        """get the array for a column, by field name or position"""
+        if isinstance(field, basestring):
+            field = self.fields.index(field)
+
+        return self.columns[field]
+
+
+    def get_partition (self, part, n_part):
+        """get zero-copy views of the columns, for one contiguous range of rows out of n_part"""
+        start = (self.n_rows * part) / n_part
+        stop = (self.n_rows * (part + 1)) / n_part
+
+        return [ column[start:stop] for column in self.columns ]
+
+
+    def _scan (self):
+        """first pass over the TSV: count rows, infer column types"""
+        n_rows = 0
+        n_cols = None
+        is_int = None
+        is_float = None
+        width = None
+
+        with open(self.file_name, "r") as f:
+            for line in f:
+                row = line.rstrip("\r\n").split("\t")
+
+                if n_cols is None:
+                    n_cols = len(row)
+                    is_int = [ True ] * n_cols
+                    is_float = [ True ] * n_cols
+                    width = [ 1 ] * n_cols
+                elif len(row) != n_cols:
+                    raise ValueError("%s line %d: expected %d columns" % (self.file_name, n_rows + 1, n_cols))
+
+                for i in xrange(n_cols):
+                    width[i] = max(width[i], len(row[i]))
+
+                    if is_int[i]:
+                        try:
+                            int(row[i])
+                        except ValueError:
+                            is_int[i] = False
+
+                    if is_float[i] and not is_int[i]:
+                        try:
+                            float(row[i])
+                        except ValueError:
+                            is_float[i] = False
+
+                n_rows += 1
+
+        dtypes = []
+
+        for i in xrange(n_cols or 0):
+            if is_int[i]:
+                dtypes.append(np.int64)
+            elif is_float[i]:
+                dtypes.append(np.float64)
+            else:
+                dtypes.append(np.dtype("S%d" % width[i]))
+
+        return n_rows, dtypes
+
+
+    def _convert (self, cache_dir, fields):
+        """second pass over the TSV: write each column into a .npy file, with bounded memory"""
+        logging.info("converting %s into columnar cache %s", self.file_name, self.path)
+
+        n_rows, dtypes = self._scan()
+
+        if not fields:
+            fields = [ "c%d" % i for i in xrange(len(dtypes)) ]
+
+        if not exists(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                # another process on this host got there first
+                pass
+
+        tmp_path = mkdtemp(prefix="convert.", dir=cache_dir)
+        columns = [ open_memmap(join(tmp_path, "col_%d.npy" % i), mode="w+", dtype=dtypes[i], shape=(n_rows,)) for i in xrange(len(dtypes)) ]
+
+        with open(self.file_name, "r") as f:
+            for j, line in enumerate(f):
+                row = line.rstrip("\r\n").split("\t")
+
+                for i in xrange(len(columns)):
+                    columns[i][j] = row[i]
+
+        for column in columns:
+            column.flush()
+
+        del columns
+
+        with open(join(tmp_path, "meta.json"), "w") as f:
+            f.write(dumps({ "file_name": self.file_name, "fields": fields, "n_rows": n_rows }))
+
+        # NB: the rename is atomic, and another process on this host
+        # may have won the race
+        try:
+            os.rename(tmp_path, self.path)
+        except OSError:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+if __name__=='__main__':
+    # a simple test
+    if len(sys.argv) < 2:
+        file_name = "dat/foo.tsv"
+    else:
+        file_name = sys.argv[1]
+
+    data = Dataset(file_name)
+
+    print data.path, data.fields, len(data)
+
+    for field in data.fields:
+        print field, data[field].dtype, data[field][:10]
@@ -18,6 +18,7 @@
 
 
 from argparse import ArgumentParser
+from logs import parse_subsystem_levels, set_up_logging
 from os.path import abspath
 from service import Framework, Worker
 from util import get_master_leader, get_master_state, pipe_slave_list
@@ -69,9 +70,15 @@ def parse_cli_args ():
     parser.add_argument("--prefix", nargs=1, default=["hdfs://exelixi"],
                         help="path prefix for durable storage")
 
-    parser.add_argument("--log", nargs=1, default=["DEBUG"],
+    parser.add_argument("--bundle", nargs=1, metavar="URI",
+                        help="file:// or hdfs:// location to publish a cached job bundle for the executors")
+
+    parser.add_argument("--log", nargs=1, default=["INFO"],
                         help="logging level: INFO, DEBUG, WARNING, ERROR, CRITICAL")
 
+    parser.add_argument("--log-levels", nargs="+", metavar="SUBSYSTEM=LEVEL",
+                        help="per-subsystem logging levels, where the subsystem is a module name, e.g., service=DEBUG contain=WARNING")
+
     return parser.parse_args()
 
 
@@ -86,16 +93,7 @@ if __name__=='__main__':
         sys.exit(0)
 
     # set up logging
-    numeric_log_level = getattr(logging, args.log[0], None)
-
-    if not isinstance(numeric_log_level, int):
-        raise ValueError("Invalid log level: %s" % loglevel)
-
-    logging.basicConfig(format="%(asctime)s\t%(levelname)s\t%(message)s", 
-                        filename="exelixi.log", 
-                        filemode="w",
-                        level=numeric_log_level
-                        )
+    set_up_logging("exelixi.log", args.log[0], parse_subsystem_levels(args.log_levels))
     logging.debug(args)
 
     # report settings for options
@@ -107,6 +105,9 @@ if __name__=='__main__':
     if args.prefix:
         opts.append(" ...using %s for the path prefix in durable storage" % (args.prefix[0]))
 
+    if args.bundle:
+        opts.append(" ...using %s to publish the job bundle" % (args.bundle[0]))
+
     # handle the different operational modes
     if args.master:
         logging.info("%s: running a Framework atop an Apache Mesos cluster", APP_NAME)
@@ -121,8 +122,10 @@ if __name__=='__main__':
             master_uri = get_master_leader(args.master[0])
             exe_path = abspath(sys.argv[0])
 
+            bundle_uri = args.bundle[0] if args.bundle else None
+
             # run Mesos driver to launch Framework and manage resource offers
-            driver = MesosScheduler.start_framework(master_uri, exe_path, args.workers[0], args.uow[0], args.prefix[0], args.cpu[0], args.mem[0])
+            driver = MesosScheduler.start_framework(master_uri, exe_path, args.workers[0], args.uow[0], args.prefix[0], args.cpu[0], args.mem[0], bundle_uri)
             MesosScheduler.stop_framework(driver)
         except ImportError as e:
             logging.critical("Python module 'mesos' has not been installed", exc_info=True)
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# author: Paco Nathan
+# https://github.com/ceteri/exelixi
+
+
+from cStringIO import StringIO
+from json import dumps, loads
+from zipfile import ZipFile, ZIP_DEFLATED
+import logging
+import numpy as np
+import sys
+
+
+######################################################################
+## class definitions
+
+class ColumnarWriter (object):
+    """write a table in chunks into a compressed columnar file: a zip archive with one .npy member per column per chunk"""
+
+    def __init__ (self, file_name, fields, list_fields=()):
+        self.file_name = file_name
+        self.fields = list(fields)
+        self.n_rows = 0
+        self.n_chunks = 0
+
+        # NB: list-valued columns get stored as the flattened values
+        # plus the offset of each row within them
+        self._list_fields = set(list_fields)
+        self._zip = ZipFile(file_name, "w", ZIP_DEFLATED, allowZip64=True)
+
+
+    def _write_array (self, name, array):
+        """write one array as a member of the archive"""
+        buf = StringIO()
+        np.save(buf, array)
+        self._zip.writestr("%05d/%s.npy" % (self.n_chunks, name), buf.getvalue())
+
+
+    def write_chunk (self, columns):
+        """write a chunk of rows, given a dict of equal-length lists per field"""
+        n_rows = len(columns[self.fields[0]])
+
+        if n_rows == 0:
+            return
+
+        for field in self.fields:
+            if field in self._list_fields:
+                lengths = [ len(x) for x in columns[field] ]
+                offsets = np.zeros(n_rows + 1, dtype=np.int64)
+                offsets[1:] = np.cumsum(lengths)
+
+                self._write_array(field + ".values", np.array([ v for x in columns[field] for v in x ]))
+                self._write_array(field + ".offsets", offsets)
+            else:
+                array = np.array(columns[field])
+
+                if array.dtype.kind == "U":
+                    # NB: fixed-width bytes take a quarter of the space
+                    array = np.char.encode(array, "utf-8")
+
+                self._write_array(field, array)
+
+        self.n_rows += n_rows
+        self.n_chunks += 1
+
+
+    def close (self):
+        """write the metadata, then close the archive"""
+        meta = { "fields": self.fields, "list_fields": sorted(self._list_fields), "n_rows": self.n_rows, "n_chunks": self.n_chunks }
+        self._zip.writestr("meta.json", dumps(meta))
+        self._zip.close()
+
+        logging.info("wrote %d rows in %d chunks to %s", self.n_rows, self.n_chunks, self.file_name)
+
+
+def read_columnar (file_name):
+    """read a file written by ColumnarWriter into one array per column; a list-valued field becomes "<field>.values" and "<field>.offsets" arrays"""
+    with ZipFile(file_name, "r") as z:
+        meta = loads(z.read("meta.json"))
+        chunks = [ {} for _ in xrange(meta["n_chunks"]) ]
+
+        for name in z.namelist():
+            if name.endswith(".npy"):
+                chunk, column = name[:-len(".npy")].split("/")
+                chunks[int(chunk)][column] = np.load(StringIO(z.read(name)))
+
+    table = {}
+
+    for field in meta["fields"]:
+        if field in meta["list_fields"]:
+            values = [ chunk[field + ".values"] for chunk in chunks ]
+            offsets = [ np.zeros(1, dtype=np.int64) ]
+            base = 0
+
+            # rebase the offsets of each chunk onto the concatenated values
+            for chunk in chunks:
+                offsets.append(chunk[field + ".offsets"][1:] + base)
+                base += len(chunk[field + ".values"])
+
+            table[field + ".values"] = np.concatenate(values) if values else np.zeros(0)
+            table[field + ".offsets"] = np.concatenate(offsets)
+        else:
+            table[field] = np.concatenate([ chunk[field] for chunk in chunks ]) if chunks else np.zeros(0)
+
+    return table
+
+
+if __name__=='__main__':
+    # a simple test
+    if len(sys.argv) < 2:
+        file_name = "/tmp/exelixi/test.zip"
+    else:
+        file_name = sys.argv[1]
+
+    writer = ColumnarWriter(file_name, [ "fitness", "gen", "key", "features" ], [ "features" ])
+    writer.write_chunk({ "fitness": [ 0.9, 0.8 ], "gen": [ 3, 4 ], "key": [ "a", "b" ], "features": [ [ 1, 2, 3 ], [ 4 ] ] })
+    writer.write_chunk({ "fitness": [ 0.7 ], "gen": [ 5 ], "key": [ "c" ], "features": [ [ 5, 6 ] ] })
+    writer.close()
+
+    table = read_columnar(file_name)
+
+    for field in sorted(table.keys()):
+        print field, table[field]
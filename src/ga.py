@@ -17,9 +17,14 @@
 # https://github.com/ceteri/exelixi
 
 
+from base64 import b64decode, b64encode
+from binascii import hexlify, unhexlify
+from bloom import get_union_fp_rate, load_bloom, AgingBloomFilter, BloomFilter
 from hat_trie import Trie
 from collections import Counter
-from gevent import Greenlet
+from export import ColumnarWriter
+from gevent import sleep, spawn, spawn_later, Greenlet
+from gevent.pool import Pool
 from hashlib import sha224
 from hashring import HashRing
 from json import dumps, loads
@@ -27,6 +32,7 @@ from monoids import dictm
 from random import random, sample
 from service import UnitOfWork
 from string import ascii_lowercase
+from surrogate import Surrogate
 from util import instantiate_class, post_distrib_rest
 import logging
 import sys
@@ -36,6 +42,40 @@ import sys
 ## class definitions
 
 class Population (UnitOfWork):
+    ## NB: override to tune load_shedding: a shard with more than
+    ## SHED_DEPTH queued fitness evaluations lets idle peers take up to
+    ## STEAL_BATCH at a time, then reclaims any which do not return
+    ## within SHED_TIMEOUT seconds
+    SHED_DEPTH = 4
+    STEAL_BATCH = 8
+    STEAL_POLL = 0.05
+    SHED_TIMEOUT = 30.0
+    ## NB: override to tune the longest backoff when a peer's
+    ## task_queue is full (seconds)
+    MAX_BACKOFF = 5.0
+    ## NB: override to tune how many reify sends may be in flight to
+    ## each peer shard at once
+    SEND_WINDOW = 8
+    ## NB: override to tune how many key digests get batched into each
+    ## test-and-set request, when using digest_dedup
+    CLAIM_BATCH = 64
+    ## NB: override to tune the Bloom filter summaries used with
+    ## bloom_prefilter: how often to publish (seconds), the initial
+    ## capacity (which doubles as needed), the false positive rate, and
+    ## the fraction of skipped births checked against their owner, to
+    ## measure the false positives
+    BLOOM_SECS = 1.0
+    BLOOM_CAPACITY = 1024
+    BLOOM_FP_RATE = 0.01
+    BLOOM_AUDIT = 0.1
+    ## NB: override to tune the bounded-memory dedup used with
+    ## dedup_memory: the number of rotating slices (each rotation
+    ## expires the oldest 1/DEDUP_SLICES of the keys) and the false
+    ## positive rate
+    DEDUP_SLICES = 4
+    DEDUP_FP_RATE = 0.001
+
+
     def __init__ (self, uow_name, prefix, indiv_instance):
         super(Population, self).__init__(uow_name, prefix)
 
@@ -46,7 +86,44 @@ class Population (UnitOfWork):
         self.current_gen = 0
 
         self._shard = {}
-        self._trie = Trie(ascii_lowercase)
+
+        if self.uow_factory.dedup_memory:
+            self._trie = AgingBloomFilter(self.uow_factory.dedup_memory, self.DEDUP_FP_RATE, self.DEDUP_SLICES)
+        else:
+            self._trie = Trie(ascii_lowercase)
+
+        self._fitness_cutoff = None
+        self._offspring_gen = 0
+        self._surrogate = None
+
+        if self.uow_factory.surrogate_rate:
+            self._surrogate = Surrogate(self.uow_factory.surrogate_rate, self.uow_factory.surrogate_audit)
+
+        # sends in flight to each peer shard, any which failed, plus the
+        # births held back while their owner shard's queue was full
+        self._outbox = {}
+        self._failed_sends = []
+        self._buffered = []
+
+        # digest dedup: the offspring awaiting a test-and-set by each
+        # owner shard, plus the traffic it took
+        self._claims = {}
+        self.claim_stats = Counter()
+
+        # Bloom filter prefilter: a summary of the local dedup registry,
+        # the latest summary published by each peer, plus a sample of
+        # the skipped births to check against each owner
+        self._bloom = None
+        self._peer_blooms = {}
+        self._bloom_audits = {}
+        self.bloom_stats = Counter()
+
+        # load shedding: the last known queue depth of each peer, plus
+        # the Individuals whose evaluation got shed onto a peer
+        self._peer_depth = {}
+        self._shed = {}
+        self.shed_count = 0
+        self.stolen_count = 0
 
 
     def perform_task (self, payload):
@@ -54,7 +131,7 @@ class Population (UnitOfWork):
         key = payload["key"]
         gen = payload["gen"]
         feature_set = payload["feature_set"]
-        self.receive_reify(key, gen, feature_set)
+        self.receive_reify(key, gen, feature_set, payload.get("parent"))
 
 
     def orchestrate (self, framework):
@@ -66,7 +143,8 @@ class Population (UnitOfWork):
         framework.send_ring_rest("pop/gen", {})
 
         while True:
-            framework.phase_barrier()
+            # NB: the barrier also returns the partial histograms
+            shard_stats = framework.phase_barrier()
 
             if self.current_gen == self.uow_factory.n_gen:
                 break
@@ -75,9 +153,8 @@ class Population (UnitOfWork):
             self.total_indiv = 0
             hist = {}
 
-            for shard_msg in framework.send_ring_rest("pop/hist", {}):
-                logging.debug(shard_msg)
-                payload = loads(shard_msg)
+            for payload in shard_stats:
+                logging.debug(payload)
                 self.total_indiv += payload["total_indiv"]
                 hist = dictm.fold([hist, payload["hist"]])
 
@@ -96,16 +173,31 @@ class Population (UnitOfWork):
             self.current_gen += 1
 
         # report the best Individuals in the final result
-        results = []
+        if self.uow_factory.results_file:
+            # write each shard's Individuals as a chunk, as it responds
+            writer = ColumnarWriter(self.uow_factory.results_file, Individual.FIELDS, [ "features" ])
 
-        for l in framework.send_ring_rest("pop/enum", { "fitness_cutoff": fitness_cutoff }):
-            results.extend(loads(l))
+            for shard_id, shard_uri in framework.get_worker_list():
+                lines = framework.send_worker_rest(shard_id, shard_uri, "pop/enum", { "fitness_cutoff": fitness_cutoff, "columnar": True })
+                writer.write_chunk(loads(lines[0]))
 
-        results.sort(reverse=True)
+            writer.close()
+        else:
+            results = []
 
-        for x in results:
-            # print results to stdout
-            print "\t".join(x)
+            for l in framework.send_ring_rest("pop/enum", { "fitness_cutoff": fitness_cutoff }):
+                results.extend(loads(l))
+
+            results.sort(reverse=True)
+
+            for x in results:
+                # print results to stdout
+                print "\t".join(x)
+
+
+    def get_barrier_stats (self):
+        """the partial histogram for the fitness distribution, returned when a phase barrier completes"""
+        return { "total_indiv": self.total_indiv, "hist": self.get_part_hist() }
 
 
     def handle_endpoints (self, worker, uri_path, env, start_response, body):
@@ -134,6 +226,22 @@ class Population (UnitOfWork):
             # test/add a new Individual into the Population (birth)
             Greenlet(self.pop_reify, worker, env, start_response, body).start()
             return True
+        elif uri_path == '/pop/claim':
+            # test-and-set a batch of key digests owned by this shard
+            Greenlet(self.pop_claim, worker, env, start_response, body).start()
+            return True
+        elif uri_path == '/pop/bloom':
+            # receive the Bloom filter summary published by a peer
+            Greenlet(self.pop_bloom, worker, env, start_response, body).start()
+            return True
+        elif uri_path == '/pop/steal':
+            # shed queued fitness evaluations onto an idle peer
+            Greenlet(self.pop_steal, worker, env, start_response, body).start()
+            return True
+        elif uri_path == '/pop/fitness':
+            # receive fitness evaluations performed by a peer
+            Greenlet(self.pop_fitness, worker, env, start_response, body).start()
+            return True
         else:
             return False
 
@@ -147,8 +255,19 @@ class Population (UnitOfWork):
         payload, start_response, body = worker.get_response_context(args[1:])
 
         if worker.auth_request(payload, start_response, body):
-            self.set_ring(worker.shard_id, worker.ring)
-            worker.prep_task_queue()
+            self.set_ring(worker.shard_id, worker.ring, worker.ring_weights)
+            worker.prep_task_queue(self.uow_factory.task_queue_limit)
+
+            if self.uow_factory.load_shedding:
+                spawn(self._steal_tasks, worker)
+
+            if self.uow_factory.bloom_prefilter:
+                if not self.uow_factory.dedup_memory:
+                    # NB: a bounded registry is itself a series of Bloom
+                    # filters, which get published directly
+                    self._bloom = BloomFilter(self.BLOOM_CAPACITY, self.BLOOM_FP_RATE)
+
+                spawn(self._publish_bloom)
 
             start_response('200 OK', [('Content-Type', 'text/plain')])
             body.put("Bokay\r\n")
@@ -177,7 +296,7 @@ class Population (UnitOfWork):
 
         if worker.auth_request(payload, start_response, body):
             start_response('200 OK', [('Content-Type', 'application/json')])
-            body.put(dumps({ "total_indiv": self.total_indiv, "hist": self.get_part_hist() }))
+            body.put(dumps(self.get_barrier_stats()))
             body.put("\r\n")
             body.put(StopIteration)
 
@@ -207,8 +326,13 @@ class Population (UnitOfWork):
         if worker.auth_request(payload, start_response, body):
             fitness_cutoff = payload["fitness_cutoff"]
 
+            if payload.get("columnar"):
+                results = self.enum_columns(fitness_cutoff)
+            else:
+                results = self.enum(fitness_cutoff)
+
             start_response('200 OK', [('Content-Type', 'application/json')])
-            body.put(dumps(self.enum(fitness_cutoff)))
+            body.put(dumps(results))
             body.put("\r\n")
             body.put(StopIteration)
 
@@ -219,27 +343,255 @@ class Population (UnitOfWork):
         payload, start_response, body = worker.get_response_context(args[1:])
 
         if worker.auth_request(payload, start_response, body):
-            worker.put_task_queue(payload)
+            if not worker.put_task_queue(payload):
+                # the bounded task_queue is full
+                worker.reject_task(start_response, body)
+                return
+
+            # NB: publish the queue depth of this shard to the sender,
+            # as a hint for load shedding
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            body.put("Bokay\r\n")
+            body.put(dumps(worker.get_queue_depth()))
+            body.put("\r\n")
+            body.put(StopIteration)
+
+
+    def pop_claim (self, *args, **kwargs):
+        """test-and-set a batch of key digests in the dedup registry of this shard (or only test them), responding with a flag per digest which is 1 if the key was new"""
+        worker = args[0]
+        payload, start_response, body = worker.get_response_context(args[1:])
+
+        if worker.auth_request(payload, start_response, body):
+            digests = b64decode(payload["digests"])
+            size = sha224().digest_size
+            keys = [ unicode(hexlify(digests[i:i + size])) for i in xrange(0, len(digests), size) ]
+
+            if payload.get("test"):
+                flags = [ "0" if key in self._trie else "1" for key in keys ]
+            else:
+                flags = [ "1" if self._claim(key) else "0" for key in keys ]
+
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            body.put("".join(flags))
+            body.put("\r\n")
+            body.put(StopIteration)
+
+
+    def pop_bloom (self, *args, **kwargs):
+        """receive the Bloom filter summary of a peer's dedup registry"""
+        worker = args[0]
+        payload, start_response, body = worker.get_response_context(args[1:])
+
+        if worker.auth_request(payload, start_response, body):
+            self._peer_blooms[payload["owner"]] = [ load_bloom(msg) for msg in payload["blooms"] ]
+
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            body.put("Bokay\r\n")
+            body.put(StopIteration)
+
+
+    def pop_steal (self, *args, **kwargs):
+        """shed up to half of the queued fitness evaluations onto an idle peer, keeping ownership of the Individuals"""
+        worker = args[0]
+        payload, start_response, body = worker.get_response_context(args[1:])
+
+        if worker.auth_request(payload, start_response, body):
+            depth = worker.get_queue_depth()
+            tasks = []
+
+            if self.uow_factory.load_shedding and depth > self.SHED_DEPTH:
+                for task in worker.take_task_queue(min(payload["n"], depth / 2)):
+                    indiv = self.indiv_class()
+                    indiv.populate(task["gen"], task["feature_set"])
+                    indiv.parent = task.get("parent")
+                    screen = self._admit(indiv)
+
+                    if screen is None:
+                        worker.done_task_queue()
+                    else:
+                        self._shed[indiv.key] = (indiv, screen)
+                        tasks.append(task)
+
+                if tasks:
+                    self.shed_count += len(tasks)
+                    spawn_later(self.SHED_TIMEOUT, self._reclaim_shed, worker, [ task["key"] for task in tasks ])
+
+            start_response('200 OK', [('Content-Type', 'application/json')])
+            body.put(dumps({ "depth": worker.get_queue_depth(), "tasks": tasks }))
+            body.put("\r\n")
+            body.put(StopIteration)
+
+
+    def pop_fitness (self, *args, **kwargs):
+        """receive fitness evaluations which were shed onto a peer"""
+        worker = args[0]
+        payload, start_response, body = worker.get_response_context(args[1:])
+
+        if worker.auth_request(payload, start_response, body):
+            for key, fitness, fitness_state in payload["results"]:
+                if key in self._shed:
+                    indiv, screen = self._shed.pop(key)
+                    indiv.parent = None
+                    indiv._fitness, indiv._fitness_state = fitness, fitness_state
+                    self._add_evaluated(indiv, screen)
+                    worker.done_task_queue()
 
             start_response('200 OK', [('Content-Type', 'text/plain')])
             body.put("Bokay\r\n")
             body.put(StopIteration)
 
 
+    ######################################################################
+    ## Bloom filter summaries of the dedup registries
+
+    def _get_summary (self):
+        """the Bloom filters which summarize the dedup registry of this shard"""
+        if self.uow_factory.dedup_memory:
+            return self._trie.get_slices()
+        else:
+            return [ self._bloom ]
+
+
+    def _publish_bloom (self):
+        """periodically publish the Bloom filter summary of this shard to its peers, whenever it has changed"""
+        published = 0
+
+        while True:
+            sleep(self.BLOOM_SECS)
+
+            if self.total_indiv == published:
+                continue
+
+            published = self.total_indiv
+            msg = { "owner": self._shard_id, "blooms": [ bloom.get_msg() for bloom in self._get_summary() ] }
+
+            for shard_id, shard_uri in self._shard_dict.items():
+                if shard_id != self._shard_id:
+                    try:
+                        post_distrib_rest(self.prefix, shard_id, shard_uri, "pop/bloom", msg)
+                        self.bloom_stats["published_bytes"] += len(dumps(msg))
+                    except Exception:
+                        logging.warning("shard %s could not publish its Bloom filter to %s", self._shard_id, shard_id)
+
+
+    def _add_bloom (self, key):
+        """add a key to the Bloom filter summary, doubling its capacity whenever it fills"""
+        if self._bloom.is_full():
+            self._bloom = BloomFilter(self._bloom.capacity * 2, self.BLOOM_FP_RATE)
+
+            for k in self._trie.keys():
+                self._bloom.add(k)
+        else:
+            self._bloom.add(key)
+
+
+    def _is_known_dup (self, shard_id, key):
+        """test whether the latest summary from a peer shard shows a key as (almost certainly) a duplicate"""
+        blooms = self._peer_blooms.get(shard_id, [])
+
+        if any([ key in bloom for bloom in blooms ]):
+            self.bloom_stats["skipped"] += 1
+
+            if random() < self.BLOOM_AUDIT:
+                if shard_id not in self._bloom_audits:
+                    self._bloom_audits[shard_id] = []
+
+                self._bloom_audits[shard_id].append(key)
+
+            return True
+        else:
+            return False
+
+
+    def _send_bloom_audits (self, shard_id, shard_uri, keys):
+        """check a sample of the skipped births against the owner's dedup registry, to measure the false positives"""
+        msg = { "digests": b64encode("".join([ unhexlify(key) for key in keys ])), "test": True }
+        lines = self._post_peer(shard_id, shard_uri, "pop/claim", msg)
+
+        self.bloom_stats["audited"] += len(keys)
+        self.bloom_stats["false_positives"] += lines[0].count("1")
+
+
+    def _count_sent (self, n, n_bytes):
+        """tally the births sent to peers, to estimate the traffic which the Bloom filter prefilter saves"""
+        if self.uow_factory.bloom_prefilter:
+            self.bloom_stats["sent"] += n
+            self.bloom_stats["sent_bytes"] += n_bytes
+
+
+    ######################################################################
+    ## load shedding between shards
+
+    def _steal_tasks (self, worker):
+        """while this shard is idle, evaluate fitness for the most backlogged peer"""
+        while True:
+            sleep(self.STEAL_POLL)
+
+            if not self._peer_depth or not worker.is_idle():
+                continue
+
+            shard_id, depth = max(self._peer_depth.items(), key=lambda x: x[1])
+
+            if depth <= self.SHED_DEPTH:
+                continue
+
+            shard_uri = self._shard_dict[shard_id]
+
+            try:
+                lines = post_distrib_rest(self.prefix, shard_id, shard_uri, "pop/steal", { "n": self.STEAL_BATCH })
+                reply = loads(lines[-1])
+                self._peer_depth[shard_id] = reply["depth"]
+
+                if reply["tasks"]:
+                    results = [ self._evaluate(task) for task in reply["tasks"] ]
+
+                    # NB: count before returning the results, since the
+                    # peer's queue may join as soon as it has them
+                    self.stolen_count += len(results)
+                    post_distrib_rest(self.prefix, shard_id, shard_uri, "pop/fitness", { "results": results })
+            except Exception:
+                # NB: the peer reclaims any evaluations which never return
+                logging.warning("shard %s could not evaluate fitness for %s", self._shard_id, shard_id)
+                self._peer_depth[shard_id] = 0
+
+
+    def _evaluate (self, task):
+        """evaluate fitness on behalf of the shard which owns the Individual; returns [key, fitness, fitness state]"""
+        indiv = self.indiv_class()
+        indiv.populate(task["gen"], task["feature_set"])
+        indiv.parent = task.get("parent")
+
+        fitness = indiv.get_fitness(self.uow_factory, force=True)
+        return [ task["key"], fitness, indiv._fitness_state ]
+
+
+    def _reclaim_shed (self, worker, keys):
+        """evaluate locally any shed fitness evaluations which a peer never returned"""
+        for key in keys:
+            if key in self._shed:
+                indiv, screen = self._shed.pop(key)
+                indiv.get_fitness(self.uow_factory, force=True)
+                self._add_evaluated(indiv, screen)
+                worker.done_task_queue()
+
+
     ######################################################################
     ## Individual lifecycle within the local subset of the Population
 
     def populate (self, current_gen):
         """initialize the population"""
-        for _ in xrange(self.uow_factory.n_pop):
+        for feature_set in self.uow_factory.generate_features_batch(self.uow_factory.n_pop):
             # constructor pattern
             indiv = self.indiv_class()
-            indiv.populate(current_gen, self.uow_factory.generate_features())
+            indiv.populate(current_gen, feature_set)
 
             # add the generated Individual to the Population
             # failure semantics: must filter nulls from initial population
             self.reify(indiv)
 
+        self._flush_outbox()
+
 
     def reify (self, indiv):
         """test/add a newly generated Individual into the Population (birth)"""
@@ -256,35 +608,233 @@ class Population (UnitOfWork):
         # using a remote task_queue with synchronization based on a
         # barrier pattern
 
-        if shard_uri:
+        if shard_uri and self._is_known_dup(neighbor_shard_id, indiv.key):
+            # NB: a false positive drops a novel offspring, which costs
+            # less than sending the many true duplicates
+            return False
+        elif shard_uri and self.uow_factory.digest_dedup:
+            # NB: screen locally, then only the digest travels to the
+            # owner; the accepted offspring stay on this shard
+            screen = self._screen(indiv)
+
+            if screen is not None:
+                self._queue_claim(neighbor_shard_id, shard_uri, indiv, screen)
+
+            return False
+        elif shard_uri:
             msg = { "key": indiv.key, "gen": indiv.gen, "feature_set": loads(indiv.get_json_feature_set()) }
-            lines = post_distrib_rest(self.prefix, neighbor_shard_id, shard_uri, "pop/reify", msg)
+
+            if indiv.parent:
+                # NB: the parent context lets the neighbor evaluate
+                # fitness incrementally
+                msg["parent"] = indiv.parent
+
+            # NB: breeding continues while the send is in flight, unless
+            # the window for that shard is full
+            self._spawn_send(self._send_reify, neighbor_shard_id, shard_uri, msg, self.uow_factory.flow_control)
             return False
         else:
             return self._reify_locally(indiv)
 
 
-    def receive_reify (self, key, gen, feature_set):
+    def receive_reify (self, key, gen, feature_set, parent=None):
         """test/add a received reify request """
         indiv = self.indiv_class()
         indiv.populate(gen, feature_set)
+        indiv.parent = parent
         self._reify_locally(indiv)
 
 
-    def _reify_locally (self, indiv):
-        """test/add a newly generated Individual into the Population locally (birth)"""
-        if not (indiv.key in self._trie):
-            self._trie[indiv.key] = 1
-            self.total_indiv += 1
+    def _admit (self, indiv):
+        """test/reserve the key for a newly generated Individual, pre-screening with any surrogate model; returns the screening context, or None if rejected"""
+        if indiv.key in self._trie:
+            return None
 
-            # potentially an expensive operation, deferred until remote reification
-            indiv.get_fitness(self.uow_factory, force=True)
-            self._shard[indiv.key] = indiv
+        screen = self._screen(indiv)
 
-            return True
+        if screen is not None:
+            self._register(indiv.key)
+
+        return screen
+
+
+    def _screen (self, indiv):
+        """pre-screen a newly generated Individual with any surrogate model; returns the screening context, or None if rejected"""
+        x, predicted, audit = None, None, False
+
+        if self._surrogate:
+            x = self.uow_factory.get_surrogate_features(indiv._feature_set)
+
+            if self._fitness_cutoff is not None:
+                # pre-screen offspring with the surrogate model,
+                # though not the initial population
+                accept, predicted, audit = self._surrogate.screen(x)
+
+                if not accept:
+                    return None
+
+        return x, predicted, audit
+
+
+    def _claim (self, key):
+        """test-and-set a key in the dedup registry of this shard; returns True if the key was new"""
+        if key in self._trie:
+            return False
+
+        self._register(key)
+        return True
+
+
+    def _register (self, key):
+        """add a key to the dedup registry of this shard"""
+        if self.uow_factory.dedup_memory:
+            self._trie.add(key)
         else:
+            self._trie[key] = 1
+
+        self.total_indiv += 1
+
+        if self._bloom is not None:
+            self._add_bloom(key)
+
+
+    def _add_evaluated (self, indiv, screen):
+        """add an admitted Individual, once its fitness has been evaluated"""
+        self._shard[indiv.key] = indiv
+
+        if self._surrogate:
+            x, predicted, audit = screen
+            self._surrogate.learn(x, indiv.get_fitness(), predicted, audit, self._fitness_cutoff)
+
+
+    def _get_outbox (self, shard_id):
+        """the pool of sends in flight to a peer shard"""
+        if shard_id not in self._outbox:
+            self._outbox[shard_id] = Pool(self.SEND_WINDOW)
+
+        return self._outbox[shard_id]
+
+
+    def _spawn_send (self, send, shard_id, shard_uri, *args):
+        """run a send to a peer shard within that shard's window, noting whether it fails"""
+        greenlet = self._get_outbox(shard_id).spawn(send, shard_id, shard_uri, *args)
+        greenlet.rawlink(self._check_send)
+
+
+    def _check_send (self, greenlet):
+        """keep any failed send, to raise once the outbox is flushed"""
+        if not greenlet.successful():
+            self._failed_sends.append(greenlet)
+
+
+    def _post_peer (self, shard_id, shard_uri, path, msg):
+        """POST a message to a peer shard; returns the response lines, or raises IOError if the peer died before responding"""
+        lines = post_distrib_rest(self.prefix, shard_id, shard_uri, path, msg)
+
+        if lines is None:
+            raise IOError("shard %s died before responding to %s" % (shard_id, path))
+
+        return lines
+
+
+    def _queue_claim (self, shard_id, shard_uri, indiv, screen):
+        """hold a screened offspring until its owner shard claims its key, sending the digests once a batch fills"""
+        if shard_id not in self._claims:
+            self._claims[shard_id] = []
+
+        batch = self._claims[shard_id]
+        batch.append((indiv, screen))
+
+        if len(batch) >= self.CLAIM_BATCH:
+            self._claims[shard_id] = []
+            self._spawn_send(self._send_claims, shard_id, shard_uri, batch)
+
+
+    def _send_claims (self, shard_id, shard_uri, batch):
+        """test-and-set a batch of key digests on their owner shard, then evaluate and keep the accepted offspring locally"""
+        msg = { "digests": b64encode("".join([ unhexlify(indiv.key) for indiv, screen in batch ])) }
+        lines = self._post_peer(shard_id, shard_uri, "pop/claim", msg)
+
+        n_bytes = len(dumps(msg))
+        self.claim_stats["sent"] += len(batch)
+        self.claim_stats["bytes"] += n_bytes
+        self._count_sent(len(batch), n_bytes)
+
+        for (indiv, screen), flag in zip(batch, lines[0].strip()):
+            if flag == "1":
+                self.claim_stats["accepted"] += 1
+                indiv.get_fitness(self.uow_factory, force=True)
+                self._add_evaluated(indiv, screen)
+
+
+    def _send_reify (self, shard_id, shard_uri, msg, flow_control):
+        """send a birth to the shard which owns it, applying the flow control policy whenever that shard's task_queue is full"""
+        delay = 0.0
+
+        if self.uow_factory.bloom_prefilter:
+            self._count_sent(1, len(dumps(msg)))
+
+        while True:
+            lines = self._post_peer(shard_id, shard_uri, "pop/reify", msg)
+
+            if len(lines) > 1:
+                self._peer_depth[shard_id] = int(lines[-1])
+
+            if not lines[0].startswith("Retry"):
+                return
+            elif flow_control == "buffer":
+                self._buffered.append((shard_id, shard_uri, msg))
+                return
+            else:
+                # back off exponentially, from the delay the shard suggests
+                delay = min(max(float(lines[0].split("\t")[1]), delay * 2.0), self.MAX_BACKOFF)
+                sleep(delay)
+
+
+    def _flush_outbox (self):
+        """wait until every send is acknowledged, then deliver the births held back during this generation, backing off as needed"""
+        for shard_id, batch in self._claims.items():
+            if batch:
+                self._spawn_send(self._send_claims, shard_id, self._shard_dict[shard_id], batch)
+
+        self._claims = {}
+
+        for shard_id, keys in self._bloom_audits.items():
+            self._spawn_send(self._send_bloom_audits, shard_id, self._shard_dict[shard_id], keys)
+
+        self._bloom_audits = {}
+
+        for pool in self._outbox.values():
+            pool.join()
+
+        failed = self._failed_sends
+        self._failed_sends = []
+
+        if failed:
+            # NB: a lost send would silently drop births, so fail as
+            # loudly as a synchronous send would have
+            logging.critical("shard %s: %d sends to peer shards failed", self._shard_id, len(failed))
+            raise failed[0].exception
+
+        buffered = self._buffered
+        self._buffered = []
+
+        for shard_id, shard_uri, msg in buffered:
+            self._send_reify(shard_id, shard_uri, msg, "backoff")
+
+
+    def _reify_locally (self, indiv):
+        """test/add a newly generated Individual into the Population locally (birth)"""
+        screen = self._admit(indiv)
+
+        if screen is None:
             return False
 
+        # potentially an expensive operation, deferred until remote reification
+        indiv.get_fitness(self.uow_factory, force=True)
+        self._add_evaluated(indiv, screen)
+        return True
+
 
     def evict (self, indiv):
         """remove an Individual from the Population (death)"""
@@ -298,6 +848,38 @@ class Population (UnitOfWork):
 
     def get_part_hist (self):
         """tally counts for the partial histogram of the fitness distribution"""
+        if self._surrogate:
+            # report on the offspring of the generation which just completed
+            report = (self._offspring_gen, self._shard_id) + self._surrogate.get_report()
+            logging.info("gen\t%d\tshard\t%s\tsurrogate screened\t%d\tsaved\t%d\tmae\t%.2e\tcorrect rejects\t%.2f", *report)
+
+        if self.shed_count or self.stolen_count:
+            # NB: each shard reports as its own queue joins, while its
+            # peers may still be shedding, so these are running totals
+            logging.info("gen\t%d\tshard\t%s\tshed total\t%d\tstole total\t%d", self._offspring_gen, self._shard_id, self.shed_count, self.stolen_count)
+
+        if self.claim_stats["sent"]:
+            stats = self.claim_stats
+            logging.info("gen\t%d\tshard\t%s\tclaimed\t%d\taccepted\t%d\tbytes per claim\t%.1f", self._offspring_gen, self._shard_id, stats["sent"], stats["accepted"], stats["bytes"] / float(stats["sent"]))
+            self.claim_stats = Counter()
+
+        if self.uow_factory.dedup_memory:
+            # report on the tradeoff between memory and duplicates
+            report = (self._offspring_gen, self._shard_id, self._trie.get_memory(), self._trie.get_count(), self._trie.expired) + self._trie.get_report() + (self._trie.get_fp_rate(),)
+            logging.info("gen\t%d\tshard\t%s\tdedup bytes\t%d\tkeys\t%d\texpired\t%d\taudited\t%d\trediscovered\t%.4f\tfalse positives\t%.4f\test fp rate\t%.4f", *report)
+
+        if self.uow_factory.bloom_prefilter:
+            stats = self.bloom_stats
+            fp_rates = [ get_union_fp_rate(blooms) for blooms in self._peer_blooms.values() ]
+            fp_rate = sum(fp_rates) / len(fp_rates) if fp_rates else 0.0
+            # NB: the fraction of the audited skips which were novel
+            measured = stats["false_positives"] / float(stats["audited"]) if stats["audited"] else 0.0
+            saved = stats["skipped"] * stats["sent_bytes"] / float(max(stats["sent"], 1))
+
+            report = (self._offspring_gen, self._shard_id, stats["skipped"], stats["sent"], stats["audited"], measured, fp_rate, saved, stats["published_bytes"])
+            logging.info("gen\t%d\tshard\t%s\tbloom skipped\t%d\tsent\t%d\taudited\t%d\tfalse positives\t%.4f\test fp rate\t%.4f\tbytes saved\t%d\tpublished\t%d", *report)
+            self.bloom_stats = Counter()
+
         l = [ round(indiv.get_fitness(self.uow_factory, force=False), self.uow_factory.hist_granularity) for indiv in self._shard.values() ]
         return dict(Counter(l))
 
@@ -328,14 +910,16 @@ class Population (UnitOfWork):
 
 
     def _boost_diversity (self, current_gen, indiv):
-        """randomly select other individuals and mutate them, to promote genetic diversity"""
+        """randomly select other individuals for mutation, to promote genetic diversity; returns True if selected"""
         if self.uow_factory.mutation_rate > random():
-            indiv.mutate(self, current_gen, self.uow_factory)
+            return True
         elif len(self._shard.values()) >= 3:
             # NB: ensure that at least three parents remain in each
             # shard per generation
             self.evict(indiv)
 
+        return False
+
 
     def _select_parents (self, current_gen, fitness_cutoff):
         """select the parents for the next generation"""
@@ -345,29 +929,43 @@ class Population (UnitOfWork):
 
         # randomly select other individuals to promote genetic
         # diversity, while removing the remnant
+        selected = []
+
         for indiv in poor_fit:
-            self._boost_diversity(current_gen, indiv)
+            if self._boost_diversity(current_gen, indiv):
+                selected.append(indiv)
+
+        mutations = self.uow_factory.mutate_features_batch([ indiv._feature_set for indiv in selected ])
+
+        for indiv, mutation in zip(selected, mutations):
+            indiv.mutate(self, current_gen, self.uow_factory, mutation)
 
         return self._shard.values()
 
 
     def next_generation (self, current_gen, fitness_cutoff):
         """select/mutate/crossover parents to produce a new generation"""
+        self._fitness_cutoff = fitness_cutoff
+        self._offspring_gen = current_gen
         parents = self._select_parents(current_gen, fitness_cutoff)
 
-        for _ in xrange(self.uow_factory.n_pop - len(parents)):
-            f, m = sample(parents, 2) 
-            success = f.breed(self, current_gen, m, self.uow_factory)
+        # NB: produce the offspring for a generation in one batch
+        couples = [ sample(parents, 2) for _ in xrange(self.uow_factory.n_pop - len(parents)) ]
+        children = self.uow_factory.breed_features_batch([ (f._feature_set, m._feature_set) for f, m in couples ])
+
+        for (f, m), feature_set in zip(couples, children):
+            success = f.breed(self, current_gen, m, self.uow_factory, feature_set)
 
         # backfill to replenish / avoid the dreaded Population collapse
         new_count = 0
 
-        for _ in xrange(self.uow_factory.n_pop - len(self._shard.values())):
+        for feature_set in self.uow_factory.generate_features_batch(max(0, self.uow_factory.n_pop - len(self._shard.values()))):
             # constructor pattern
             indiv = self.indiv_class()
-            indiv.populate(current_gen, self.uow_factory.generate_features())
+            indiv.populate(current_gen, feature_set)
             self.reify(indiv)
 
+        self._flush_outbox()
         logging.info("gen\t%d\tshard\t%s\tsize\t%d\ttotal\t%d", current_gen, self._shard_id, len(self._shard.values()), self.total_indiv)
 
 
@@ -382,20 +980,50 @@ class Population (UnitOfWork):
                 for indiv in filter(lambda x: x.get_fitness() >= fitness_cutoff, self._shard.values()) ]
 
 
+    def enum_columns (self, fitness_cutoff):
+        """enum all Individuals that exceed the given fitness cutoff, as typed columns"""
+        elite = filter(lambda x: x.get_fitness() >= fitness_cutoff, self._shard.values())
+        columns = { field: [] for field in Individual.FIELDS }
+
+        for indiv in elite:
+            columns["fitness"].append(indiv.get_fitness())
+            columns["gen"].append(indiv.gen)
+            columns["key"].append(indiv.key)
+            columns["features"].append(indiv._feature_set)
+
+        return columns
+
+
 class Individual (object):
+    # the columns for a columnar export
+    FIELDS = [ "fitness", "gen", "key", "features" ]
+
     def __init__ (self):
         """create an Individual member of the Population"""
         self.gen = None
         self.key = None
+        self.parent = None
         self._feature_set = None
         self._fitness = None
+        self._fitness_state = None
 
 
     def get_fitness (self, uow_factory=None, force=False):
         """determine the fitness ranging [0.0, 1.0]; higher is better"""
         if uow_factory and uow_factory.use_force(force):
-            # potentially the most expensive operation, deferred with careful consideration
-            self._fitness = uow_factory.get_fitness(self._feature_set)
+            result = None
+
+            if self.parent:
+                # incremental evaluation, from the parent context
+                parent_states, delta = self.parent
+                result = uow_factory.get_fitness_delta(self._feature_set, parent_states, delta)
+                self.parent = None
+
+            if result is None:
+                # potentially the most expensive operation, deferred with careful consideration
+                result = uow_factory.get_fitness_state(self._feature_set)
+
+            self._fitness, self._fitness_state = result
 
         return self._fitness
 
@@ -416,11 +1044,21 @@ class Individual (object):
         self.key = unicode(m.hexdigest())
 
 
-    def mutate (self, pop, gen, uow_factory):
-        """attempt to mutate the feature set"""
+    def set_parent (self, parents, delta):
+        """keep the parent context for an incremental fitness evaluation, if the parents have state for it"""
+        parent_states = [ parent._fitness_state for parent in parents ]
+
+        if None not in parent_states:
+            self.parent = [ parent_states, delta ]
+
+
+    def mutate (self, pop, gen, uow_factory, mutation=None):
+        """attempt to mutate the feature set, unless given a (feature set, delta) mutation from a batch"""
         # constructor pattern
         mutant = self.__class__()
-        mutant.populate(gen, uow_factory.mutate_features(self._feature_set))
+        feature_set, delta = mutation or uow_factory.mutate_features_delta(self._feature_set)
+        mutant.populate(gen, feature_set)
+        mutant.set_parent([ self ], delta)
 
         # add the mutant Individual to the Population, but remove its prior self
         # failure semantics: ignore, mutation rate is approx upper bounds
@@ -431,11 +1069,16 @@ class Individual (object):
             return False
 
 
-    def breed (self, pop, gen, mate, uow_factory):
-        """breed with a mate to produce a child"""
+    def breed (self, pop, gen, mate, uow_factory, feature_set=None):
+        """breed with a mate to produce a child, unless given the child's feature set from a batch"""
         # constructor pattern
         child = self.__class__()
-        child.populate(gen, uow_factory.breed_features(self._feature_set, mate._feature_set))
+
+        if feature_set is None:
+            feature_set = uow_factory.breed_features(self._feature_set, mate._feature_set)
+
+        child.populate(gen, feature_set)
+        child.set_parent([ self, mate ], None)
 
         # add the child Individual to the Population
         # failure semantics: ignore, the count will rebalance over the hash ring
@@ -472,5 +1115,10 @@ if __name__=='__main__':
         uow.current_gen += 1
 
     # report summary
-    for x in sorted(uow.enum(fitness_cutoff), reverse=True):
-        print "\t".join(x)
+    if uow_factory.results_file:
+        writer = ColumnarWriter(uow_factory.results_file, Individual.FIELDS, [ "features" ])
+        writer.write_chunk(uow.enum_columns(fitness_cutoff))
+        writer.close()
+    else:
+        for x in sorted(uow.enum(fitness_cutoff), reverse=True):
+            print "\t".join(x)
@@ -29,19 +29,27 @@
 # http://amix.dk/blog/post/19367
 
 
+from bisect import bisect_left
 import md5
 
 
 class HashRing(object):
 
-    def __init__(self, nodes=None, replicas=3):
+    def __init__(self, nodes=None, replicas=3, weights=None):
         """Manages a hash ring.
 
         `nodes` is a list of objects that have a proper __str__ representation.
         `replicas` indicates how many virtual points should be used pr. node,
         replicas are required to improve the distribution.
+        `weights` optionally maps nodes to their relative capacity, so that
+        each node gets a proportional share of the virtual points (and keys).
         """
         self.replicas = replicas
+        self.weights = {}
+
+        if weights:
+            mean = sum(weights.values()) / float(len(weights))
+            self.weights = dict([ (node, w / mean) for node, w in weights.items() ])
 
         self.ring = dict()
         self._sorted_keys = []
@@ -50,10 +58,15 @@ class HashRing(object):
             for node in nodes:
                 self.add_node(node)
 
+    def get_replicas(self, node):
+        """Returns the number of virtual points for `node`, based on its weight.
+        """
+        return max(1, int(round(self.replicas * self.weights.get(node, 1.0))))
+
     def add_node(self, node):
         """Adds a `node` to the hash ring (including a number of replicas).
         """
-        for i in xrange(0, self.replicas):
+        for i in xrange(0, self.get_replicas(node)):
             key = self.gen_key('%s:%s' % (node, i))
             self.ring[key] = node
             self._sorted_keys.append(key)
@@ -63,7 +76,7 @@ class HashRing(object):
     def remove_node(self, node):
         """Removes `node` from the hash ring and its replicas.
         """
-        for i in xrange(0, self.replicas):
+        for i in xrange(0, self.get_replicas(node)):
             key = self.gen_key('%s:%s' % (node, i))
             del self.ring[key]
             self._sorted_keys.remove(key)
@@ -87,10 +100,10 @@ class HashRing(object):
         key = self.gen_key(string_key)
 
         nodes = self._sorted_keys
-        for i in xrange(0, len(nodes)):
-            node = nodes[i]
-            if key <= node:
-                return self.ring[node], i
+        i = bisect_left(nodes, key)
+
+        if i < len(nodes):
+            return self.ring[nodes[i]], i
 
         return self.ring[nodes[0]], 0
 
@@ -134,3 +147,14 @@ if __name__=='__main__':
     print ring.get_node('my_key')
     print ring.get_node('foo bar')
     print ring.get_node(str(random.random()))
+
+    # share of the keys owned by each node, weighted by capacity
+    weights = dict(zip(memcache_servers, [ 1.0, 2.0, 4.0 ]))
+    ring = HashRing(memcache_servers, replicas=64, weights=weights)
+    counts = dict([ (node, 0) for node in memcache_servers ])
+
+    for _ in xrange(70000):
+        counts[ring.get_node(str(random.random()))] += 1
+
+    for node in memcache_servers:
+        print "%s weight %0.1f share %0.3f" % (node, weights[node], counts[node] / 70000.0)
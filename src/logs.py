@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# author: Paco Nathan
+# https://github.com/ceteri/exelixi
+
+
+from collections import deque
+from threading import Lock, Thread
+from time import sleep, time
+import logging
+import sys
+
+
+######################################################################
+## globals
+
+LOG_FORMAT = "%(asctime)s\t%(levelname)s\t%(message)s"
+
+
+######################################################################
+## class definitions
+
+class Lazy (object):
+    """defer an expensive log argument, e.g., a JSON dump of a payload, until the record actually gets formatted"""
+
+    def __init__ (self, func, *args):
+        self._func = func
+        self._args = args
+
+
+    def __str__ (self):
+        return str(self._func(*self._args))
+
+
+class Sampler (object):
+    """let through only one in every n occurrences of a high-frequency event"""
+
+    def __init__ (self, every_n):
+        self.every_n = every_n
+        self.count = 0
+
+
+    def ready (self):
+        """count an occurrence, returning True for the first and then every n-th one"""
+        self.count += 1
+        return (self.count - 1) % self.every_n == 0
+
+
+class SubsystemFilter (logging.Filter):
+    """per-subsystem log levels, where the subsystem is the module which logged the record"""
+
+    def __init__ (self, default_level, levels):
+        logging.Filter.__init__(self)
+        self.default_level = default_level
+        self.levels = levels
+
+
+    def filter (self, record):
+        return record.levelno >= self.levels.get(record.module, self.default_level)
+
+
+class BackgroundHandler (logging.Handler):
+    """buffer log records in memory, then format and write them in batches from a background thread, to keep file I/O out of the request handlers"""
+
+    def __init__ (self, file_name, mode="a", flush_secs=0.25, max_buffer=100000):
+        logging.Handler.__init__(self)
+        self._stream = open(file_name, mode)
+        self._flush_secs = flush_secs
+        self._max_buffer = max_buffer
+
+        # NB: deque appends and pops are atomic, so the request
+        # handlers never wait on the writer
+        self._buffer = deque()
+        self._write_lock = Lock()
+        self.dropped = 0
+
+        self._thread = Thread(target=self._run, name="log-writer")
+        self._thread.daemon = True
+        self._thread.start()
+
+
+    def emit (self, record):
+        """buffer a record; drop it rather than block if the writer has fallen far behind"""
+        if len(self._buffer) >= self._max_buffer:
+            self.dropped += 1
+            return
+
+        try:
+            # NB: interpolate now, since the args may change before the
+            # writer gets to them
+            record.msg = record.getMessage()
+            record.args = None
+            self._buffer.append(record)
+        except Exception:
+            self.handleError(record)
+
+
+    def _run (self):
+        """flush periodically, for the life of the process"""
+        while True:
+            sleep(self._flush_secs)
+            self.flush()
+
+
+    def flush (self):
+        """format and write all of the buffered records"""
+        with self._write_lock:
+            if self._stream.closed:
+                return
+
+            lines = []
+
+            while self._buffer:
+                lines.append(self.format(self._buffer.popleft()))
+
+            if self.dropped > 0:
+                msg = "log buffer full, dropped %d records" % self.dropped
+                lines.append(self.format(logging.makeLogRecord({ "msg": msg, "levelno": logging.WARNING, "levelname": "WARNING" })))
+                self.dropped = 0
+
+            if lines:
+                self._stream.write("\n".join(lines) + "\n")
+                self._stream.flush()
+
+
+    def close (self):
+        """write any remaining records, then close the log file"""
+        self.flush()
+
+        with self._write_lock:
+            self._stream.close()
+
+        logging.Handler.close(self)
+
+
+######################################################################
+## utility functions
+
+def get_log_level (level_name):
+    """convert the name of a log level into its numeric value"""
+    level = getattr(logging, level_name.upper(), None)
+
+    if not isinstance(level, int):
+        raise ValueError("Invalid log level: %s" % level_name)
+
+    return level
+
+
+def parse_subsystem_levels (specs):
+    """parse a list of SUBSYSTEM=LEVEL strings into a dict of numeric log levels"""
+    levels = {}
+
+    for spec in specs or []:
+        subsystem, level_name = spec.split("=", 1)
+        levels[subsystem.strip()] = get_log_level(level_name.strip())
+
+    return levels
+
+
+def set_up_logging (file_name, level_name, subsystem_levels=None):
+    """log to a file through a background writer, with an overall log level plus optional per-subsystem levels"""
+    default_level = get_log_level(level_name)
+    levels = subsystem_levels or {}
+
+    # NB: skip the thread and process lookups for each record, since
+    # the log format does not use them
+    logging.logThreads = 0
+    logging.logProcesses = 0
+    logging.logMultiprocessing = 0
+
+    handler = BackgroundHandler(file_name, mode="w")
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    handler.addFilter(SubsystemFilter(default_level, levels))
+
+    # NB: the root logger lets through the most verbose level among
+    # the subsystems, then the filter applies the per-subsystem levels
+    root = logging.getLogger()
+    root.addHandler(handler)
+    root.setLevel(min([ default_level ] + levels.values()))
+
+    return handler
+
+
+if __name__=='__main__':
+    ## benchmark a hot path which logs each payload at DEBUG, while
+    ## running at INFO level
+    from json import dumps
+
+    if len(sys.argv) < 2:
+        file_name = "/tmp/exelixi/test.log"
+    else:
+        file_name = sys.argv[1]
+
+    set_up_logging(file_name, "INFO", parse_subsystem_levels([ "logs=INFO" ]))
+    payload = { "key": "a3b5c7", "gen": 42, "feature_set": range(100), "parent": None }
+    n = 20000
+
+    t0 = time()
+
+    for _ in xrange(n):
+        logging.debug(dumps(payload))
+
+    t_eager = time() - t0
+    t0 = time()
+
+    for _ in xrange(n):
+        logging.debug("%s", Lazy(dumps, payload))
+
+    t_lazy = time() - t0
+    sampler = Sampler(1000)
+    t0 = time()
+
+    for i in xrange(n):
+        if sampler.ready():
+            logging.info("payload %d %s", i, Lazy(dumps, payload))
+
+    t_sampled = time() - t0
+    t0 = time()
+
+    for i in xrange(n):
+        logging.info("payload %d", i)
+
+    t_buffered = time() - t0
+
+    # compare with the synchronous file handler used previously
+    root = logging.getLogger()
+    root.handlers[0].close()
+    root.handlers = []
+    logging.basicConfig(format=LOG_FORMAT, filename=file_name, filemode="w", level=logging.INFO)
+    t0 = time()
+
+    for i in xrange(n):
+        logging.info("payload %d", i)
+
+    t_sync = time() - t0
+
+    print "disabled DEBUG: eager %0.2f us/call, lazy %0.2f us/call" % (1.0e6 * t_eager / n, 1.0e6 * t_lazy / n)
+    print "sampled INFO: %0.2f us/call" % (1.0e6 * t_sampled / n)
+    print "enabled INFO: background writer %0.2f us/call, synchronous %0.2f us/call" % (1.0e6 * t_buffered / n, 1.0e6 * t_sync / n)
@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# author: Paco Nathan
+# https://github.com/ceteri/exelixi
+
+
+from collections import namedtuple
+from contain import Container, ContainerUOW, ContainerUOWFactory
+from gevent import Greenlet
+from itertools import chain
+from json import dumps, loads
+from monoids import summ
+from tempfile import TemporaryFile
+from util import post_distrib_rest
+from zlib import crc32
+import logging
+import sys
+
+
+######################################################################
+## class definitions
+
+class SpillBuffer (object):
+    """combine (key, value) pairs with a monoid in memory, spilling to partitioned files on disk beyond a cap"""
+
+    def __init__ (self, monoid, max_keys, part_fn, parts):
+        self.monoid = monoid
+        self.max_keys = max_keys
+        self.spill_count = 0
+
+        self._part_fn = part_fn
+        self._parts = list(parts)
+        self._data = {}
+        self._spill = None
+
+
+    def add (self, key, value):
+        """combine a (lifted) value into the buffer"""
+        if key in self._data:
+            self._data[key] = self.monoid.op(self._data[key], value)
+        else:
+            self._data[key] = value
+
+        if len(self._data) > self.max_keys:
+            self._spill_data()
+
+
+    def _spill_data (self):
+        """append the buffer contents to the spill file for each partition, then empty the buffer"""
+        if not self._spill:
+            self._spill = { part: TemporaryFile(prefix="exelixi-", suffix=".spill") for part in self._parts }
+
+        for key, value in self._data.iteritems():
+            self._spill[self._part_fn(key)].write(dumps([ key, value ]) + "\n")
+
+        logging.debug("spilled %d keys", len(self._data))
+        self._data = {}
+        self.spill_count += 1
+
+
+    def iter_part (self, part, merge=False):
+        """iterate over the (key, value) pairs in one partition, optionally merging the spilled runs by key"""
+        pairs = ( (key, value) for key, value in self._data.iteritems() if self._part_fn(key) == part )
+
+        if self._spill:
+            f = self._spill[part]
+            f.flush()
+            f.seek(0)
+            pairs = chain(( tuple(loads(line)) for line in f ), pairs)
+
+        if merge:
+            # NB: only one partition at a time needs to fit in memory
+            merged = {}
+
+            for key, value in pairs:
+                if key in merged:
+                    merged[key] = self.monoid.op(merged[key], value)
+                else:
+                    merged[key] = value
+
+            pairs = merged.iteritems()
+
+        return pairs
+
+
+class MapReduceContainer (Container):
+    """Container for a distrib Py MapReduce job, by default a word count"""
+
+    def __init__ (self):
+        super(MapReduceContainer, self).__init__()
+
+        ## NB: override to define how values get combined and reduced
+        self.monoid = summ
+        ## NB: override to define the fields of a result tuple
+        self.Result = namedtuple('KeyValue', ['key', 'value'])
+
+
+    def data_load (self, file_name):
+        """load the specified data file"""
+        ## NB: override to load the data file
+        with open(file_name, "r") as f:
+            self.param_space.extend([ line.rstrip("\r\n") for line in f ])
+
+
+    def map (self, params):
+        """map a param space element into a sequence of (key, value) pairs, where keys are strings"""
+        ## NB: override to define the map
+        for word in params.split("\t"):
+            yield word, 1
+
+
+    def reduce (self, key, value):
+        """finalize the combined value for one key"""
+        ## NB: override to define the reduce
+        return self.Result(key, value)
+
+
+class MapReduceUOWFactory (ContainerUOWFactory):
+    """UnitOfWorkFactory definition for distrib Py MapReduce jobs"""
+
+    def instantiate_uow (self, uow_name, prefix):
+        return MapReduceUOW(uow_name, prefix, MapReduceContainer())
+
+
+class MapReduceUOW (ContainerUOW):
+    """UnitOfWork definition for distrib Py MapReduce jobs: map, combine, shuffle over the HashRing, then reduce"""
+
+    ## NB: override to tune the memory cap (distinct keys per buffer)
+    ## and the batching of shuffle traffic
+    MAX_BUFFER_KEYS = 100000
+    SHUFFLE_BATCH = 1000
+    N_BUCKETS = 16
+
+    # NB: map output gets combined as it is produced, so a duplicate
+    # run of a chunk cannot be dropped afterwards
+    SPECULATE_AGE = None
+
+
+    def __init__ (self, uow_name, prefix, container):
+        super(MapReduceUOW, self).__init__(uow_name, prefix, container)
+
+        self._map_buffer = None
+        self._reduce_buffer = None
+
+
+    def set_ring (self, shard_id, shard_dict, weights=None):
+        """initialize the HashRing, which determines the owner shard for each intermediate key"""
+        super(MapReduceUOW, self).set_ring(shard_id, shard_dict, weights)
+
+        monoid = self._container.monoid
+
+        # map side: partitioned by owner shard, for the shuffle
+        self._map_buffer = SpillBuffer(monoid, self.MAX_BUFFER_KEYS, self._get_owner, shard_dict.keys())
+
+        # reduce side: partitioned into buckets which each fit in memory
+        self._reduce_buffer = SpillBuffer(monoid, self.MAX_BUFFER_KEYS, self._get_bucket, xrange(self.N_BUCKETS))
+
+
+    def _get_owner (self, key):
+        """map-side partition for a key, i.e., its owner shard"""
+        return self._hash_ring.get_node(key.encode("utf-8"))
+
+
+    def _get_bucket (self, key):
+        """reduce-side partition for a key"""
+        return crc32(key.encode("utf-8")) % self.N_BUCKETS
+
+
+    def perform_task (self, payload):
+        """perform a task consumed from the Worker.task_queue"""
+        if "job" in payload:
+            # map, then combine locally
+            lift = self._container.monoid.lift
+
+            for key, value in self._container.map(payload["job"]):
+                # NB: keys arrive as unicode after a shuffle, so
+                # normalize them for consistent hashing and merging
+                if isinstance(key, str):
+                    key = key.decode("utf-8")
+
+                self._map_buffer.add(key, lift(value))
+
+        elif "pairs" in payload:
+            # combine the shuffled pairs owned by this shard
+            for key, value in payload["pairs"]:
+                self._reduce_buffer.add(key, value)
+
+        elif "nop" in payload:
+            pass
+
+
+    def orchestrate (self, framework):
+        """initialize shards, then map, shuffle and reduce"""
+        self.load_shards(framework)
+
+        self.distribute_params(framework)
+        framework.phase_barrier()
+
+        framework.send_ring_rest("mr/shuffle", {})
+        framework.phase_barrier()
+
+        framework.send_ring_rest("mr/reduce", {})
+        framework.phase_barrier()
+
+        self.report_results(framework)
+
+
+    def handle_endpoints (self, worker, uri_path, env, start_response, body):
+        """UnitOfWork REST endpoints, delegated from the Worker"""
+        if uri_path == '/mr/shuffle':
+            # send the combined map output to the owner shards
+            Greenlet(self.mr_shuffle, worker, env, start_response, body).start()
+            return True
+        elif uri_path == '/mr/recv':
+            # receive a batch of shuffled pairs
+            Greenlet(self.mr_recv, worker, env, start_response, body).start()
+            return True
+        elif uri_path == '/mr/reduce':
+            # reduce the pairs owned by this shard
+            Greenlet(self.mr_reduce, worker, env, start_response, body).start()
+            return True
+        else:
+            return super(MapReduceUOW, self).handle_endpoints(worker, uri_path, env, start_response, body)
+
+
+    ######################################################################
+    ## MapReduce-specific REST endpoints implemented as gevent coroutines
+
+    def mr_shuffle (self, *args, **kwargs):
+        """send the combined map output to the owner shards, in batches"""
+        worker = args[0]
+        payload, start_response, body = worker.get_response_context(args[1:])
+
+        if worker.auth_request(payload, start_response, body):
+            with worker.wrap_task_event():
+                # HTTP response first, then initiate long-running task
+                start_response('200 OK', [('Content-Type', 'text/plain')])
+                body.put("Bokay\r\n")
+                body.put(StopIteration)
+
+                logging.info("shard %s map buffer spilled %d times", self._shard_id, self._map_buffer.spill_count)
+
+                for shard_id in sorted(self._shard_dict.keys()):
+                    batch = []
+
+                    for key, value in self._map_buffer.iter_part(shard_id):
+                        batch.append([ key, value ])
+
+                        if len(batch) >= self.SHUFFLE_BATCH:
+                            self._send_batch(worker, shard_id, batch)
+                            batch = []
+
+                    if len(batch) > 0:
+                        self._send_batch(worker, shard_id, batch)
+
+
+    def _send_batch (self, worker, shard_id, batch):
+        """send a batch of pairs to the task_queue of their owner shard"""
+        if shard_id == self._shard_id:
+            worker.put_task_queue({ "pairs": batch })
+        else:
+            post_distrib_rest(self.prefix, shard_id, self._shard_dict[shard_id], "mr/recv", { "pairs": batch })
+
+
+    def mr_recv (self, *args, **kwargs):
+        """receive a batch of shuffled pairs"""
+        worker = args[0]
+        payload, start_response, body = worker.get_response_context(args[1:])
+
+        if worker.auth_request(payload, start_response, body):
+            worker.put_task_queue({ "pairs": payload["pairs"] })
+
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            body.put("Bokay\r\n")
+            body.put(StopIteration)
+
+
+    def mr_reduce (self, *args, **kwargs):
+        """reduce the pairs owned by this shard, one bucket at a time, into the results"""
+        worker = args[0]
+        payload, start_response, body = worker.get_response_context(args[1:])
+
+        if worker.auth_request(payload, start_response, body):
+            with worker.wrap_task_event():
+                # HTTP response first, then initiate long-running task
+                start_response('200 OK', [('Content-Type', 'text/plain')])
+                body.put("Bokay\r\n")
+                body.put(StopIteration)
+
+                logging.info("shard %s reduce buffer spilled %d times", self._shard_id, self._reduce_buffer.spill_count)
+
+                for bucket in xrange(self.N_BUCKETS):
+                    for key, value in self._reduce_buffer.iter_part(bucket, merge=True):
+                        self._write_result(None, dumps(self._container.reduce(key, value)))
+
+
+if __name__=='__main__':
+    ## test the combine + spill in standalone-mode, without distributed services
+    buf = SpillBuffer(summ, 3, lambda key: len(key) % 2, [ 0, 1 ])
+
+    for word in "the quick brown fox jumps over the lazy dog and the end".split(" "):
+        buf.add(word, 1)
+
+    for part in [ 0, 1 ]:
+        print part, sorted(buf.iter_part(part, merge=True))
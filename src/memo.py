@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# author: Paco Nathan
+# https://github.com/ceteri/exelixi
+
+
+from collections import OrderedDict
+from glob import glob
+from hashlib import sha224
+from json import dumps
+from os.path import basename, exists, getsize, join
+from time import time
+from uuid import uuid1
+import logging
+import os
+import sys
+
+
+######################################################################
+## class definitions
+
+class ResultStore (object):
+    """persistent memo of calculation results, kept in local on-disk segments with an index and an LRU size cap"""
+
+    ## NB: override to tune the granularity of eviction
+    SEGMENT_BYTES = 4 * 1024 * 1024
+
+
+    def __init__ (self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+
+        self.hits = 0
+        self.misses = 0
+
+        # key -> (segment, offset, length)
+        self._index = {}
+
+        # segment -> bytes, in order from least to most recently used
+        self._segments = OrderedDict()
+
+        self._seg_name = None
+        self._data_file = None
+        self._idx_file = None
+
+        if not exists(path):
+            try:
+                os.makedirs(path)
+            except OSError:
+                # another process on this host got there first
+                pass
+
+        self._load_index()
+
+
+    @staticmethod
+    def get_key (fingerprint, params):
+        """key a calculation by its params and the version of the data on which it runs"""
+        m = sha224()
+        m.update(dumps([ fingerprint, params ], sort_keys=True))
+        return m.hexdigest()
+
+
+    def get (self, key):
+        """lookup a memoized result (as a JSON string), or None on a miss"""
+        loc = self._index.get(key)
+        value = None
+
+        if loc:
+            seg_name, offset, length = loc
+
+            try:
+                with open(join(self.path, seg_name + ".dat"), "rb") as f:
+                    f.seek(offset)
+                    value = f.read(length)
+            except IOError:
+                # segment evicted by another process on this host
+                value = None
+
+            if value is not None and len(value) < length:
+                # torn write
+                value = None
+
+        if value is None:
+            self.misses += 1
+            return None
+        else:
+            self.hits += 1
+
+            # NB: promote to the active segment, so the oldest segment
+            # only ever holds the least recently used results
+            if seg_name != self._seg_name:
+                self._append(key, value)
+
+            return value
+
+
+    def put (self, key, value):
+        """memoize a result (as a JSON string)"""
+        if key not in self._index:
+            self._append(key, value)
+
+
+    def get_hit_rate (self):
+        """fraction of lookups answered from the store"""
+        n = self.hits + self.misses
+        return self.hits / float(n) if n > 0 else 0.0
+
+
+    def close (self):
+        """close the active segment"""
+        if self._data_file:
+            self._data_file.close()
+            self._idx_file.close()
+            self._data_file = None
+            self._idx_file = None
+            self._seg_name = None
+
+
+    def _load_index (self):
+        """rebuild the index from the segment index files, oldest first"""
+        for idx_path in sorted(glob(join(self.path, "*.idx"))):
+            seg_name = basename(idx_path)[:-len(".idx")]
+            data_path = join(self.path, seg_name + ".dat")
+
+            if not exists(data_path):
+                continue
+
+            with open(idx_path, "r") as f:
+                for line in f:
+                    try:
+                        key, offset, length = line.rstrip("\n").split("\t")
+                        self._index[key] = (seg_name, int(offset), int(length))
+                    except ValueError:
+                        # torn write
+                        pass
+
+            self._segments[seg_name] = getsize(data_path)
+
+        logging.info("result store %s: %d results in %d segments", self.path, len(self._index), len(self._segments))
+
+
+    def _open_segment (self):
+        """start a new active segment, named so that segments sort by age"""
+        self.close()
+
+        # NB: several processes on a host may share the store, so each
+        # writes to its own segments
+        self._seg_name = "%016d-%s" % (int(time() * 1.0e6), uuid1().hex[:8])
+        self._data_file = open(join(self.path, self._seg_name + ".dat"), "ab")
+        self._idx_file = open(join(self.path, self._seg_name + ".idx"), "a")
+        self._segments[self._seg_name] = 0
+
+
+    def _append (self, key, value):
+        """append a result to the active segment, then enforce the size cap"""
+        if not self._data_file or self._segments[self._seg_name] >= self.SEGMENT_BYTES:
+            self._open_segment()
+
+        offset = self._segments[self._seg_name]
+
+        # data first, then the index entry which points at it
+        self._data_file.write(value + "\n")
+        self._data_file.flush()
+
+        self._idx_file.write("%s\t%d\t%d\n" % (key, offset, len(value)))
+        self._idx_file.flush()
+
+        self._index[key] = (self._seg_name, offset, len(value))
+        self._segments[self._seg_name] = offset + len(value) + 1
+
+        self._evict()
+
+
+    def _evict (self):
+        """drop the least recently used segments, until the store fits within its size cap"""
+        while sum(self._segments.values()) > self.max_bytes and len(self._segments) > 1:
+            seg_name, size = self._segments.popitem(last=False)
+
+            if seg_name == self._seg_name:
+                # never evict the active segment
+                self._segments[seg_name] = size
+                break
+
+            for ext in (".dat", ".idx"):
+                try:
+                    os.remove(join(self.path, seg_name + ext))
+                except OSError:
+                    pass
+
+            for key in [ key for key, loc in self._index.items() if loc[0] == seg_name ]:
+                del self._index[key]
+
+            logging.debug("result store %s: evicted segment %s", self.path, seg_name)
+
+
+if __name__=='__main__':
+    # a simple test
+    if len(sys.argv) < 2:
+        path = "/tmp/exelixi/memo"
+    else:
+        path = sys.argv[1]
+
+    store = ResultStore(path, 1024 * 1024)
+    store.SEGMENT_BYTES = 4096
+
+    for i in xrange(1000):
+        key = ResultStore.get_key("test", i % 300)
+
+        if store.get(key) is None:
+            store.put(key, dumps([ i % 300, (i % 300) ** 2 ]))
+
+    store.close()
+    print "hits", store.hits, "misses", store.misses, "hit rate %0.4f" % store.get_hit_rate()
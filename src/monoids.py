@@ -5,6 +5,9 @@
 # http://fmota.eu/blog/monoids-in-python.html
 # see also: http://arxiv.org/abs/1304.7544
 
+from copy import copy
+
+
 class Monoid (object):
     def __init__ (self, null, lift, op):
         self.null = null
@@ -15,7 +18,9 @@ class Monoid (object):
         if hasattr(xs, "__fold__"):
             return xs.__fold__(self)
         else:
-            return reduce(self.op, (self.lift(x) for x in xs), self.null)
+            # NB: ops such as dict_op update in place, so never hand
+            # them the shared null
+            return reduce(self.op, (self.lift(x) for x in xs), copy(self.null))
  
     def __call__ (self, *args):
         return self.fold(args)
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# author: Paco Nathan
+# https://github.com/ceteri/exelixi
+
+
+from time import time
+import numpy as np
+import sys
+
+
+######################################################################
+## permutation-preserving genetic operators, batched: each takes a
+## 2-D array with one permutation of the same genes per row (genes are
+## non-negative ints) and returns a new array of valid permutations
+
+def _get_cuts (n_rows, n):
+    """pick a random segment [a, b) per row, with 0 <= a < b <= n"""
+    a = np.random.randint(0, n, size=n_rows)
+    b = np.random.randint(0, n, size=n_rows)
+    lo = np.minimum(a, b)
+    hi = np.maximum(a, b) + 1
+    return lo, hi
+
+
+def _get_segment_mask (lo, hi, n):
+    """boolean mask of the positions within each row's segment"""
+    pos = np.arange(n)
+    return (pos >= lo[:, None]) & (pos < hi[:, None])
+
+
+def order_crossover (fathers, mothers, cuts=None):
+    """order crossover (OX): keep a segment of the father, then fill the rest with the mother's genes in her order, starting after the segment"""
+    n_rows, n = fathers.shape
+    lo, hi = cuts or _get_cuts(n_rows, n)
+    rows = np.arange(n_rows)[:, None]
+
+    keep = _get_segment_mask(lo, hi, n)
+    children = np.where(keep, fathers, -1)
+
+    # which genes each child already has from its father
+    has_gene = np.zeros((n_rows, fathers.max() + 1), dtype=bool)
+    has_gene[np.nonzero(keep)[0], fathers[keep]] = True
+
+    # walk both the mother and the child from the end of the segment,
+    # wrapping around; row-major order lines up the fills per row
+    wrap = (hi[:, None] + np.arange(n)) % n
+    mother_genes = mothers[rows, wrap]
+    fill = mother_genes[~has_gene[rows, mother_genes]]
+    free = ~keep[rows, wrap]
+
+    children[np.nonzero(free)[0], wrap[free]] = fill
+    return children
+
+
+def pmx_crossover (fathers, mothers, cuts=None):
+    """partially mapped crossover (PMX): keep a segment of the father, then place the mother's genes, mapping any conflicts through the segment"""
+    n_rows, n = fathers.shape
+    lo, hi = cuts or _get_cuts(n_rows, n)
+    rows = np.arange(n_rows)[:, None]
+
+    keep = _get_segment_mask(lo, hi, n)
+    children = np.where(keep, fathers, mothers)
+
+    # map each gene in the father's segment to the mother's gene at
+    # the same position
+    n_genes = max(fathers.max(), mothers.max()) + 1
+    seg_rows = np.nonzero(keep)[0]
+    in_segment = np.zeros((n_rows, n_genes), dtype=bool)
+    in_segment[seg_rows, fathers[keep]] = True
+    mapping = np.tile(np.arange(n_genes), (n_rows, 1))
+    mapping[seg_rows, fathers[keep]] = mothers[keep]
+
+    # NB: each pass resolves one more link in the mapping chains,
+    # which are never longer than the segment
+    conflict = ~keep & in_segment[rows, children]
+
+    while conflict.any():
+        genes = children[conflict]
+        children[conflict] = mapping[np.nonzero(conflict)[0], genes]
+        conflict = ~keep & in_segment[rows, children]
+
+    return children
+
+
+def swap_mutation (routes):
+    """swap two random genes per row; returns the mutants plus the two positions"""
+    n_rows, n = routes.shape
+    rows = np.arange(n_rows)
+    i = np.random.randint(0, n, size=n_rows)
+    j = np.random.randint(0, n, size=n_rows)
+
+    mutants = routes.copy()
+    mutants[rows, i] = routes[rows, j]
+    mutants[rows, j] = routes[rows, i]
+    return mutants, i, j
+
+
+def inversion_mutation (routes, cuts=None):
+    """reverse a random segment per row, i.e., a 2-opt move"""
+    n_rows, n = routes.shape
+    lo, hi = cuts or _get_cuts(n_rows, n)
+    pos = np.arange(n)
+
+    index = np.where(_get_segment_mask(lo, hi, n), lo[:, None] + hi[:, None] - 1 - pos, pos)
+    return routes[np.arange(n_rows)[:, None], index]
+
+
+def is_permutation (routes, genes):
+    """test whether each row is a permutation of the given genes"""
+    return (np.sort(routes, axis=1) == np.sort(genes)).all(axis=1)
+
+
+if __name__=='__main__':
+    ## benchmark against the original point mutation and splice, within a
+    ## Population in standalone-mode: run from the top-level directory
+    from random import randint, seed
+    from sample_tsplib import TSPLIBFactory
+
+    if len(sys.argv) < 2:
+        target = 0.82
+    else:
+        target = float(sys.argv[1])
+
+    genes = np.arange(1, 11)
+    fathers = np.array([ np.random.permutation(genes) for _ in xrange(1000) ])
+    mothers = np.array([ np.random.permutation(genes) for _ in xrange(1000) ])
+
+    for op in [ order_crossover(fathers, mothers), pmx_crossover(fathers, mothers), swap_mutation(fathers)[0], inversion_mutation(fathers) ]:
+        assert is_permutation(op, genes).all()
+
+    class NaiveTSPFactory (TSPLIBFactory):
+        """the original point mutation and half/half splice, on the same problem"""
+
+        def mutate_features_delta (self, feature_set):
+            pos = randint(0, len(feature_set) - 1)
+            mutated_feature_set = list(feature_set)
+            mutated_feature_set[pos] = randint(self.min, self.max)
+            return mutated_feature_set, [ [ pos, feature_set[pos], mutated_feature_set[pos] ] ]
+
+        def breed_features (self, f_feature_set, m_feature_set):
+            half = len(f_feature_set) / 2
+            return f_feature_set[half:] + m_feature_set[:half]
+
+        def mutate_features_batch (self, feature_sets):
+            return [ self.mutate_features_delta(feature_set) for feature_set in feature_sets ]
+
+        def breed_features_batch (self, couples):
+            return [ self.breed_features(f_feature_set, m_feature_set) for f_feature_set, m_feature_set in couples ]
+
+    for label, uow_factory in [ ("naive", NaiveTSPFactory()), ("permute", TSPLIBFactory()) ]:
+        ## NB: fixed seeds, so that each run reports the same numbers
+        seed(0)
+        np.random.seed(0)
+        pop = uow_factory.instantiate_uow("sample_tsplib.TSPLIBFactory", "/tmp/exelixi")
+        pop.uow_factory = uow_factory
+        n_eval = [ 0, 0 ]
+        get_fitness_state = uow_factory.get_fitness_state
+        get_fitness_delta = uow_factory.get_fitness_delta
+
+        def count_eval (result):
+            if result:
+                n_eval[0] += 1
+                n_eval[1] += result[1][1] == 0
+
+            return result
+
+        uow_factory.get_fitness_state = lambda *args: count_eval(get_fitness_state(*args))
+        uow_factory.get_fitness_delta = lambda *args: count_eval(get_fitness_delta(*args))
+
+        t0 = time()
+        pop.populate(0)
+        fit_max = 0.0
+
+        while pop.current_gen < 200:
+            hist = pop.get_part_hist()
+            hist_items = map(lambda x: (float(x[0]), x[1],), sorted(hist.items(), reverse=True))
+            fit_max = hist_items[0][0]
+
+            if fit_max >= target:
+                break
+
+            pop.next_generation(pop.current_gen, pop.get_fitness_cutoff(hist_items))
+            pop.current_gen += 1
+
+        elapsed = time() - t0
+        print "%-8s gen %3d  max %0.4f  evals %6d  valid %5.1f%%  useful evals/sec %8.1f" % (label, pop.current_gen, fit_max, n_eval[0], 100.0 * n_eval[1] / n_eval[0], n_eval[1] / elapsed)
@@ -20,7 +20,7 @@
 from json import dumps, loads
 from service import Framework, Worker, WorkerInfo
 from threading import Thread
-from util import get_telemetry
+from util import get_bundle_exe_path, get_telemetry, publish_bundle, BUNDLE_CACHE, BUNDLE_LAUNCHER
 from uuid import uuid1
 import logging
 import mesos
@@ -209,7 +209,7 @@ class MesosScheduler (mesos.Scheduler):
 
 
     @staticmethod
-    def start_framework (master_uri, exe_path, n_workers, uow_name, prefix, cpu_alloc, mem_alloc):
+    def start_framework (master_uri, exe_path, n_workers, uow_name, prefix, cpu_alloc, mem_alloc, bundle_uri=None):
         # initialize an executor
         executor = mesos_pb2.ExecutorInfo()
         executor.executor_id.value = uuid1().hex
@@ -217,10 +217,18 @@ class MesosScheduler (mesos.Scheduler):
         executor.name = "Exelixi Executor"
         executor.source = "per-job build"
 
-        ## NB: TODO download tarball/container from HDFS
-        #uri = executor.command.uris.add()
-        #uri.executable = false
-        #uri.value = "hdfs://namenode/exelixi/exelixi.tgz"
+        if bundle_uri:
+            # Mesos fetches only the small launcher script, which then
+            # downloads/unpacks the job bundle on a cache miss
+            digest, tgz_uri, launcher_uri = publish_bundle(bundle_uri, uow_name)
+
+            uri = executor.command.uris.add()
+            uri.executable = True
+            uri.value = launcher_uri
+
+            executor.command.value = "./%s %s %s %s" % (BUNDLE_LAUNCHER, tgz_uri, digest, BUNDLE_CACHE)
+            executor.source = digest
+            exe_path = get_bundle_exe_path(digest)
 
         # initialize the framework
         framework = mesos_pb2.FrameworkInfo()
@@ -297,8 +305,6 @@ class MesosExecutor (mesos.Executor):
             ## NB: TODO test port availability...
             update.data = str(dumps(get_telemetry(), indent=4))
 
-            ## NB: TODO download tarball/container for service launch
-
             # notify scheduler: ready to launch service
             logging.debug(update.data)
             driver.sendStatusUpdate(update)
@@ -19,9 +19,12 @@
 
 from collections import namedtuple
 from copy import deepcopy
+from itertools import chain
 from random import randint, sample
+from time import time
 from uow import UnitOfWorkFactory
 import logging
+import numpy as np
 import sys
 
 
@@ -37,6 +40,15 @@ DIR_S = Point(0, 1)	# DIR_W
 DIR_E = Point(-1, 0)	# DIR_S
 DIR_N = Point(0, -1)	# DIR_E
 
+# opcodes, pre-decoded for the fast simulator
+OP_REND, OP_TURN, OP_SUP, OP_LOOP = range(len(OPS))
+
+# headings for the fast simulator, in the order Drone.exec_op_turn
+# visits them: once the drone faces (0, 1) it never turns again
+DIR_X = ( 1, 0, -1, 0 )
+DIR_Y = ( 0, -1, 0, 1 )
+LAST_DIR = len(DIR_X) - 1
+
 
 class Drone (object):
     def __init__ (self, x, y):
@@ -111,6 +123,11 @@ class LMDFactory (UnitOfWorkFactory):
         self.min = 0
         self.max = len(OPS) - 1
 
+        # reusable mask for the fast simulator: a cell has been mowed
+        # during the current evaluation iff it holds the current epoch
+        self._mowed = [ 0 ] * self.length
+        self._epoch = 0
+
 
     def generate_features (self):
         """generate a new feature set for a lawnmower drone"""
@@ -201,8 +218,8 @@ class LMDFactory (UnitOfWorkFactory):
             return result
 
 
-    def get_fitness (self, feature_set):
-        """determine the fitness ranging [0.0, 1.0]; higher is better"""
+    def _get_fitness_sim (self, feature_set):
+        """determine the fitness with the reference simulator, which mows a copy of the grid"""
         drone = Drone(randint(0, len(self.grid)), randint(0, len(self.grid)))
         grid = self._simulate(deepcopy(self.grid), feature_set, drone)
         fitness = 0.0
@@ -224,7 +241,205 @@ class LMDFactory (UnitOfWorkFactory):
         return fitness
 
 
+    def _count_mowed (self, code):
+        """run a GP program in the fast simulator, counting the cells mowed; None if the program is invalid"""
+        # NB: control flow never depends on the grid, and the grid
+        # wraps around, so the count is the same from any start
+        # position -- the drone starts at (0, 0) here
+        mod = len(self.grid)
+        max_ops = self.length
+        n = len(code)
+        mowed = self._mowed
+
+        self._epoch += 1
+        epoch = self._epoch
+
+        sp = 0
+        num_ops = 0
+        heading = 0
+        x = y = 0
+        count = 0
+
+        while sp < n and num_ops < max_ops:
+            num_ops += 1
+            op = code[sp]
+
+            if op == OP_REND:
+                x = (x + DIR_X[heading]) % mod
+                y = (y + DIR_Y[heading]) % mod
+
+            elif op == OP_TURN:
+                if heading < LAST_DIR:
+                    heading += 1
+
+                sp += 1
+                continue
+
+            elif op == OP_SUP:
+                if sp + 2 >= n:
+                    return None
+
+                sup_x = code[sp + 1]
+                sup_y = code[sp + 2]
+                sp += 2
+
+                if sup_x == 0 and sup_y == 0:
+                    return None
+
+                x = (x + sup_x) % mod
+                y = (y + sup_y) % mod
+
+            elif op == OP_LOOP:
+                if sp + 1 >= n:
+                    return None
+
+                offset = code[sp + 1]
+
+                if offset == 0 or offset > sp:
+                    return None
+
+                sp += 1 - offset
+                continue
+
+            else:
+                return None
+
+            cell = y * mod + x
+
+            if mowed[cell] != epoch:
+                mowed[cell] = epoch
+                count += 1
+
+            sp += 1
+
+        return count
+
+
+    def get_fitness (self, feature_set):
+        """determine the fitness ranging [0.0, 1.0]; higher is better"""
+        count = self._count_mowed(feature_set)
+        fitness = 0.0
+
+        if count is not None:
+            fitness = count / float(self.length)
+
+            if len(feature_set) > 5:
+                penalty = len(feature_set) / 10.0
+                fitness /= penalty
+
+        return fitness
+
+
+    def get_fitness_batch (self, feature_sets):
+        """determine the fitness for a list of GP programs, stepping all of them in lockstep"""
+        mod = len(self.grid)
+        n_prog = len(feature_sets)
+
+        if n_prog == 0:
+            return []
+
+        lengths = np.array([ len(feature_set) for feature_set in feature_sets ], dtype=np.int64)
+
+        # pre-decode the programs into one flat opcode array, with each
+        # row padded so that argument lookups stay within the row
+        width = lengths.max() + 3
+        flat = np.fromiter(chain.from_iterable(feature_sets), dtype=np.int32, count=lengths.sum())
+        row_base = np.arange(n_prog, dtype=np.int64) * width
+        row_start = np.cumsum(lengths) - lengths
+
+        code = np.full(n_prog * width, -1, dtype=np.int32)
+        code[np.arange(len(flat)) + np.repeat(row_base - row_start, lengths)] = flat
+
+        dir_x = np.array(DIR_X, dtype=np.int32)
+        dir_y = np.array(DIR_Y, dtype=np.int32)
+
+        pc = np.zeros(n_prog, dtype=np.int64)
+        heading = np.zeros(n_prog, dtype=np.int32)
+        x = np.zeros(n_prog, dtype=np.int32)
+        y = np.zeros(n_prog, dtype=np.int32)
+        failed = np.zeros(n_prog, dtype=bool)
+        running = lengths > 0
+
+        # one column per cell, plus a sink column for programs which
+        # do not mow on a given step
+        sink = self.length
+        mowed = np.zeros((n_prog, sink + 1), dtype=bool)
+        mowed_base = np.arange(n_prog, dtype=np.int64) * (sink + 1)
+
+        # NB: finished programs keep stepping through the same ops as
+        # no-ops, which costs less than gathering the running rows
+        for num_ops in xrange(self.length):
+            if not running.any():
+                break
+
+            i = row_base + pc
+            op = code.take(i)
+            arg_1 = code.take(i + 1)
+            arg_2 = code.take(i + 2)
+
+            is_rend = op == OP_REND
+            is_turn = op == OP_TURN
+            is_sup = op == OP_SUP
+            is_loop = op == OP_LOOP
+
+            bad = (op < OP_REND) | (op > OP_LOOP)
+            bad |= is_sup & ((pc + 2 >= lengths) | ((arg_1 == 0) & (arg_2 == 0)))
+            bad |= is_loop & ((pc + 1 >= lengths) | (arg_1 == 0) | (arg_1 > pc))
+            bad &= running
+            failed |= bad
+
+            move = (is_rend | is_sup) & running & ~bad
+            x = np.where(move, (x + np.where(is_sup, arg_1, dir_x.take(heading))) % mod, x)
+            y = np.where(move, (y + np.where(is_sup, arg_2, dir_y.take(heading))) % mod, y)
+            mowed.ravel()[mowed_base + np.where(move, y * mod + x, sink)] = True
+
+            heading = np.where(is_turn & running, np.minimum(heading + 1, LAST_DIR), heading)
+
+            pc = np.where(running & ~bad, pc + 1 + 2 * is_sup - np.where(is_loop, arg_1, 0), pc)
+            running &= ~bad & (pc < lengths)
+
+        count = mowed[:, :sink].sum(axis=1)
+        fitness = count / float(self.length)
+
+        penalty = np.where(lengths > 5, lengths / 10.0, 1.0)
+        fitness = np.where(lengths > 5, fitness / penalty, fitness)
+        fitness[failed] = 0.0
+
+        return fitness.tolist()
+
+
 if __name__=='__main__':
     uow = LMDFactory()
 
     print uow.grid
+
+    ## compare the simulators on a mix of generated, mutated and bred
+    ## programs, as a population would see them
+    if len(sys.argv) < 2:
+        n_prog = 3000
+    else:
+        n_prog = int(sys.argv[1])
+
+    programs = [ uow.generate_features() for _ in xrange(n_prog / 3) ]
+    programs.extend([ uow.mutate_features(f) for f in programs[:n_prog / 3] ])
+    programs.extend([ uow.breed_features(*sample(programs, 2)) for _ in xrange(n_prog - len(programs)) ])
+
+    t0 = time()
+    expected = [ uow._get_fitness_sim(f) for f in programs ]
+    t_sim = time() - t0
+
+    t0 = time()
+    fast = [ uow.get_fitness(f) for f in programs ]
+    t_fast = time() - t0
+
+    t0 = time()
+    batch = uow.get_fitness_batch(programs)
+    t_batch = time() - t0
+
+    assert fast == expected, "fast simulator differs from the reference"
+    assert batch == expected, "batch simulator differs from the reference"
+
+    print "%d programs, %d valid" % (n_prog, sum(1 for f in expected if f > 0.0))
+
+    for label, elapsed in [ ("reference", t_sim), ("fast", t_fast), ("batch", t_batch) ]:
+        print "%-10s %8.0f evals/sec  %6.1fx" % (label, n_prog / elapsed, t_sim / elapsed)
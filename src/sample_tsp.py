@@ -17,9 +17,11 @@
 # https://github.com/ceteri/exelixi
 
 
-from random import randint, sample
+from permute import order_crossover, swap_mutation
+from random import sample
 from uow import UnitOfWorkFactory
 import logging
+import numpy as np
 import sys
 
 
@@ -59,6 +61,9 @@ class TSPFactory (UnitOfWorkFactory):
                             ( 8, 5, 18, 18, 19, 0 ),
                             )
 
+        # the worst case: a round trip from home to each stop
+        self.worst_case = float(sum(self.route_cost[0])) * 2.0
+
         # sampling parameters
         self.length = len(self.route_cost) - 1
         self.min = 1
@@ -81,31 +86,38 @@ class TSPFactory (UnitOfWorkFactory):
 
     def mutate_features (self, feature_set):
         """mutate a copy of the given feature set"""
-        pos_to_mutate = randint(0, len(feature_set) - 1)
-        mutated_feature_set = list(feature_set)
-        mutated_feature_set[pos_to_mutate] = randint(self.min, self.max)
-        return mutated_feature_set
+        return self.mutate_features_delta(feature_set)[0]
+
+
+    def mutate_features_delta (self, feature_set):
+        """swap two stops in a copy of the given route, also describing the change as a list of [pos, old stop, new stop]"""
+        mutants, i, j = swap_mutation(np.array([ feature_set ]))
+        i, j = int(i[0]), int(j[0])
+        return mutants[0].tolist(), [ [ i, feature_set[i], feature_set[j] ], [ j, feature_set[j], feature_set[i] ] ]
 
 
     def breed_features (self, f_feature_set, m_feature_set):
-        """breed two feature sets to produce a child"""
-        half = len(f_feature_set) / 2
-        return f_feature_set[half:] + m_feature_set[:half]
+        """breed two routes with an order crossover, which always produces a valid route"""
+        return order_crossover(np.array([ f_feature_set ]), np.array([ m_feature_set ]))[0].tolist()
 
 
     def get_fitness (self, feature_set):
         """determine the fitness ranging [0.0, 1.0]; higher is better"""
+        return self.get_fitness_state(feature_set)[0]
+
+
+    def get_fitness_state (self, feature_set):
+        """determine the fitness, plus the state [total cost, number of missing stops] for incremental evaluation"""
         #print feature_set
 
         # 1st estimator: all points were visited?
         expected = set(xrange(self.min, self.max + 1))
         observed = set(feature_set)
-        cost1 = len(expected - observed) / float(len(expected))
-        #print expected, observed, cost1
+        missing = len(expected - observed)
+        #print expected, observed, missing
 
         # 2nd estimator: travel time was minimized?
         total_cost = 0
-        worst_case = float(sum(self.route_cost[0])) * 2.0
         x0 = 0
 
         for x1 in feature_set:
@@ -113,16 +125,61 @@ class TSPFactory (UnitOfWorkFactory):
             x0 = x1
 
         total_cost += self.route_cost[x0][0]
-        cost2 = min(1.0, total_cost / worst_case)
-        #print total_cost, worst_case, cost2
 
-        # combine the two estimators into a fitness score
+        return self._combine_estimators(missing, total_cost), [ total_cost, missing ]
+
+
+    def get_fitness_delta (self, feature_set, parent_states, delta):
+        """determine the fitness of a mutant from its parent's state, re-costing only the edges next to each changed stop"""
+        if delta is None:
+            # a bred child: evaluate it in full
+            return None
+
+        total_cost, missing = parent_states[0]
+
+        if sorted([ old for pos, old, new in delta ]) != sorted([ new for pos, old, new in delta ]):
+            if missing > 0 or len(delta) > 1:
+                # NB: would need to know how often each stop appears in
+                # the parent's route
+                return None
+
+            # every stop appeared exactly once in the parent's route,
+            # so the replaced stop is now missing
+            missing = 1
+
+        # the parent's stop at each changed position
+        parent_stop = dict([ (pos, old) for pos, old, new in delta ])
+
+        # edge i runs from position i - 1 to position i, where both
+        # ends of the route are home
+        last = len(feature_set)
+        edges = set([ pos for pos in parent_stop ] + [ pos + 1 for pos in parent_stop ])
+
+        for i in edges:
+            x0 = feature_set[i - 1] if i > 0 else 0
+            x1 = feature_set[i] if i < last else 0
+            total_cost += self.route_cost[x0][x1]
+
+            x0 = parent_stop.get(i - 1, x0)
+            x1 = parent_stop.get(i, x1)
+            total_cost -= self.route_cost[x0][x1]
+
+        return self._combine_estimators(missing, total_cost), [ total_cost, missing ]
+
+
+    def _combine_estimators (self, missing, total_cost):
+        """combine the coverage and travel time estimators into a fitness score"""
+        cost1 = missing / float(self.max - self.min + 1)
+
+        cost2 = min(1.0, total_cost / self.worst_case)
+        #print total_cost, self.worst_case, cost2
+
         fitness = 1.0 - (cost1 + cost2) / 2.0
 
         if cost1 > 0.0:
             fitness /= 2.0
 
-        #print cost1, cost2, fitness, feature_set
+        #print cost1, cost2, fitness
         return fitness
 
 
@@ -131,3 +188,16 @@ if __name__=='__main__':
 
     print uow.route_meta
     print uow.route_cost
+
+    ## check the incremental evaluation of mutants against a full one
+    feature_set = uow.generate_features()
+    fitness, state = uow.get_fitness_state(feature_set)
+
+    for _ in xrange(1000):
+        mutant, delta = uow.mutate_features_delta(feature_set)
+        result = uow.get_fitness_delta(mutant, [ state ], delta)
+
+        if result:
+            assert result == uow.get_fitness_state(mutant), (feature_set, mutant, result)
+
+    print feature_set, fitness
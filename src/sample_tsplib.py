@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# author: Paco Nathan
+# https://github.com/ceteri/exelixi
+
+
+from math import sqrt
+from numpy.lib.format import open_memmap
+from os.path import abspath, exists, getsize, join
+from permute import order_crossover, swap_mutation
+from random import shuffle
+from sample_tsp import TSPFactory
+from tempfile import mkstemp
+from time import time
+from util import get_file_fingerprint
+import logging
+import numpy as np
+import os
+import sys
+
+
+######################################################################
+## utility functions
+
+CACHE_DIR = "/tmp/exelixi/data"
+
+
+def _get_distance (weight_type, coords, i):
+    """distances from node i to every node, per the TSPLIB edge weight type"""
+    dx = coords[:, 0] - coords[i, 0]
+    dy = coords[:, 1] - coords[i, 1]
+
+    if weight_type == "EUC_2D":
+        return np.floor(np.sqrt(dx * dx + dy * dy) + 0.5)
+    elif weight_type == "CEIL_2D":
+        return np.ceil(np.sqrt(dx * dx + dy * dy))
+    elif weight_type == "ATT":
+        r = np.sqrt((dx * dx + dy * dy) / 10.0)
+        t = np.floor(r + 0.5)
+        return np.where(t < r, t + 1.0, t)
+    else:
+        raise ValueError("unsupported EDGE_WEIGHT_TYPE %s" % weight_type)
+
+
+def _get_explicit_matrix (weight_format, n, weights):
+    """unpack the EDGE_WEIGHT_SECTION of a TSPLIB file into a full matrix"""
+    matrix = np.zeros((n, n), dtype=np.float32)
+
+    if weight_format == "FULL_MATRIX":
+        matrix[:] = np.array(weights, dtype=np.float32).reshape((n, n))
+    else:
+        if weight_format == "UPPER_ROW":
+            rows, cols = np.triu_indices(n, 1)
+        elif weight_format == "LOWER_DIAG_ROW":
+            rows, cols = np.tril_indices(n)
+        elif weight_format == "UPPER_DIAG_ROW":
+            rows, cols = np.triu_indices(n)
+        elif weight_format == "LOWER_ROW":
+            rows, cols = np.tril_indices(n, -1)
+        else:
+            raise ValueError("unsupported EDGE_WEIGHT_FORMAT %s" % weight_format)
+
+        matrix[rows, cols] = weights
+        matrix[cols, rows] = weights
+
+    return matrix
+
+
+def convert_tsplib (file_name, npy_file):
+    """convert a symmetric TSPLIB file into a float32 cost matrix, one row at a time for the coordinate types"""
+    spec = {}
+    coords = []
+    weights = []
+    section = None
+
+    with open(file_name, "r") as f:
+        for line in f:
+            line = line.strip()
+
+            if not line or line == "EOF":
+                continue
+            elif line.endswith("_SECTION"):
+                section = line
+            elif section is None:
+                key, value = line.split(":", 1)
+                spec[key.strip()] = value.strip()
+            elif section == "NODE_COORD_SECTION":
+                coords.append([ float(x) for x in line.split()[1:3] ])
+            elif section == "EDGE_WEIGHT_SECTION":
+                weights.extend([ float(x) for x in line.split() ])
+
+    n = int(spec["DIMENSION"])
+    weight_type = spec.get("EDGE_WEIGHT_TYPE", "EUC_2D")
+    matrix = open_memmap(npy_file, mode="w+", dtype=np.float32, shape=(n, n))
+
+    if weight_type == "EXPLICIT":
+        matrix[:] = _get_explicit_matrix(spec.get("EDGE_WEIGHT_FORMAT", "FULL_MATRIX"), n, weights)
+    else:
+        coords = np.array(coords, dtype=np.float64)
+
+        for i in xrange(n):
+            matrix[i] = _get_distance(weight_type, coords, i)
+
+    matrix.flush()
+    del matrix
+
+
+def load_cost_matrix (file_name, cache_dir=CACHE_DIR):
+    """memory-map a square cost matrix read-only, from a TSPLIB file (converted once per host) or a raw float32 file"""
+    file_name = abspath(file_name)
+
+    if file_name.endswith(".tsp"):
+        npy_file = join(cache_dir, get_file_fingerprint(file_name) + ".npy")
+
+        if not exists(npy_file):
+            logging.info("converting %s into cost matrix %s", file_name, npy_file)
+
+            if not exists(cache_dir):
+                try:
+                    os.makedirs(cache_dir)
+                except OSError:
+                    # another process on this host got there first
+                    pass
+
+            fd, tmp_file = mkstemp(prefix="convert.", suffix=".npy", dir=cache_dir)
+            os.close(fd)
+            convert_tsplib(file_name, tmp_file)
+
+            # NB: the rename is atomic, and another process on this
+            # host may have won the race
+            os.rename(tmp_file, npy_file)
+
+        return np.load(npy_file, mmap_mode="r")
+    else:
+        n = int(round(sqrt(getsize(file_name) / 4)))
+
+        if n * n * 4 != getsize(file_name):
+            raise ValueError("%s is not a square float32 matrix" % file_name)
+
+        return np.memmap(file_name, dtype=np.float32, mode="r", shape=(n, n))
+
+
+######################################################################
+## class definitions
+
+class TSPLIBFactory (TSPFactory):
+    """UnitOfWork definition for large Traveling Salesperson Problems, with the cost matrix memory-mapped from a file"""
+
+    ## NB: override to load a different TSPLIB file (*.tsp) or raw
+    ## float32 matrix; node 0 is home
+    COST_FILE = "dat/rand100.tsp"
+
+
+    def __init__ (self):
+        super(TSPLIBFactory, self).__init__()
+
+        self.n_pop = 100
+        self.n_gen = 100
+        self.max_indiv = 20000
+        self.selection_rate = 0.2
+        self.mutation_rate = 0.2
+
+        # NB: read-only memory map, so that every shard on a host shares
+        # the same pages
+        self.route_cost = load_cost_matrix(self.COST_FILE)
+        self.route_meta = None
+
+        self.worst_case = float(self.route_cost[0].sum(dtype=np.float64)) * 2.0
+
+        # sampling parameters
+        self.length = len(self.route_cost) - 1
+        self.min = 1
+        self.max = self.length
+
+
+    def generate_features (self):
+        """generate a random route through all of the stops"""
+        features = range(self.min, self.max + 1)
+        shuffle(features)
+        return features
+
+
+    def generate_features_batch (self, k):
+        """generate k random routes through all of the stops"""
+        return (np.argsort(np.random.random_sample((k, self.length)), axis=1) + self.min).tolist()
+
+
+    def mutate_features_batch (self, feature_sets):
+        """swap two stops in copies of the given routes, also describing each change as per mutate_features_delta"""
+        if len(feature_sets) == 0:
+            return []
+
+        mutants, i, j = swap_mutation(np.array(feature_sets))
+        deltas = [ [ [ i0, f[i0], f[j0] ], [ j0, f[j0], f[i0] ] ] for f, i0, j0 in zip(feature_sets, i.tolist(), j.tolist()) ]
+        return zip(mutants.tolist(), deltas)
+
+
+    def breed_features_batch (self, couples):
+        """breed a list of (f_feature_set, m_feature_set) couples with an order crossover"""
+        if len(couples) == 0:
+            return []
+
+        f_features = np.array([ f_feature_set for f_feature_set, m_feature_set in couples ])
+        m_features = np.array([ m_feature_set for f_feature_set, m_feature_set in couples ])
+        return order_crossover(f_features, m_features).tolist()
+
+
+    def get_fitness_state (self, feature_set):
+        """determine the fitness, plus the state [total cost, number of missing stops] for incremental evaluation"""
+        route = np.array(feature_set, dtype=np.intp)
+
+        # 1st estimator: all points were visited?
+        observed = np.bincount(route, minlength=self.max + 1)[self.min:]
+        missing = int(len(observed) - np.count_nonzero(observed))
+
+        # 2nd estimator: travel time was minimized?
+        tour = np.concatenate(([ 0 ], route, [ 0 ]))
+        total_cost = float(self.route_cost[tour[:-1], tour[1:]].sum(dtype=np.float64))
+
+        return self._combine_estimators(missing, total_cost), [ total_cost, missing ]
+
+
+if __name__=='__main__':
+    ## benchmark fitness evaluation on random instances, where the
+    ## cost matrix is a raw float32 file
+    for n in [ 1000, 5000 ]:
+        file_name = "/tmp/exelixi/tsp_%d.bin" % n
+
+        if not exists(file_name):
+            if not exists("/tmp/exelixi"):
+                os.makedirs("/tmp/exelixi")
+
+            coords = np.random.uniform(0.0, 1000.0, size=(n, 2))
+
+            with open(file_name, "wb") as f:
+                for i in xrange(n):
+                    _get_distance("EUC_2D", coords, i).astype(np.float32).tofile(f)
+
+        TSPLIBFactory.COST_FILE = file_name
+        uow = TSPLIBFactory()
+        routes = [ uow.generate_features() for _ in xrange(100) ]
+
+        t0 = time()
+        expected = [ TSPFactory.get_fitness_state(uow, route) for route in routes ]
+        t_loop = time() - t0
+
+        t0 = time()
+        observed = [ uow.get_fitness_state(route) for route in routes ]
+        t_vec = time() - t0
+
+        for (fit_e, state_e), (fit_o, state_o) in zip(expected, observed):
+            assert abs(fit_e - fit_o) < 1.0e-9 and state_e[1] == state_o[1]
+
+        print "n %d\tloop %8.1f evals/sec\tvectorized %8.1f evals/sec\t%6.1fx" % (n, len(routes) / t_loop, len(routes) / t_vec, t_loop / t_vec)
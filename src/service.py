@@ -18,15 +18,18 @@
 
 
 from contextlib import contextmanager
-from gevent import monkey, shutdown, signal, spawn, wsgi, Greenlet
+from gevent import monkey, shutdown, signal, sleep, spawn, wsgi, Greenlet
 from gevent.event import Event
-from gevent.queue import JoinableQueue
+from gevent.queue import Full, JoinableQueue
 from hashring import HashRing
 from json import dumps, loads
+from math import ceil
 from signal import SIGQUIT
+from telemetry import get_capacity, get_cpu_secs, TelemetrySampler, TelemetryView
 from util import instantiate_class, post_distrib_rest
 from uuid import uuid1
 import logging
+import socket
 import sys
 
 
@@ -39,6 +42,9 @@ class Worker (object):
     # http://blog.pythonisito.com/2012/07/gevent-and-greenlets.html
 
     DEFAULT_PORT = "9311"
+    ## NB: override to tune the delay suggested to senders when a
+    ## bounded task_queue is full (seconds)
+    RETRY_SECS = 0.1
 
 
     def __init__ (self, port=DEFAULT_PORT):
@@ -52,14 +58,20 @@ class Worker (object):
         self.prefix = None
         self.shard_id = None
         self.ring = None
+        self.ring_weights = None
 
         # concurrency based on message passing / barrier pattern
         self._task_event = None
         self._task_queue = None
+        self.queue_high_water = 0
+        self.queue_rejects = 0
 
         # UnitOfWork
         self._uow = None
 
+        # telemetry pushed to the Framework
+        self._telemetry = None
+
 
     def shard_start (self):
         """start the worker service for this shard"""
@@ -118,13 +130,64 @@ class Worker (object):
             ff = instantiate_class(uow_name)
             self._uow = ff.instantiate_uow(uow_name, self.prefix)
 
+            # the Framework listens for telemetry at the address which
+            # sent this request
+            if payload.get("telemetry_port"):
+                host = args[0]["REMOTE_ADDR"]
+
+                if host.startswith("::ffff:"):
+                    # NB: IPv4 address mapped onto a dual-stack socket
+                    host = host[len("::ffff:"):]
+
+                telemetry_uri = host + ":" + str(payload["telemetry_port"])
+                self._telemetry = spawn(self._push_telemetry, telemetry_uri)
+
+            # NB: respond with the capacity of this host, in case the
+            # Framework has no resource offers from which to weight
+            # the HashRing
             start_response('200 OK', [('Content-Type', 'text/plain')])
             body.put("Bokay\r\n")
+            body.put(dumps(get_capacity()))
+            body.put("\r\n")
             body.put(StopIteration)
 
             logging.info("configuring shard %s prefix %s", self.shard_id, self.prefix)
 
 
+    ######################################################################
+    ## telemetry methods
+
+    def get_queue_depth (self):
+        """count the tasks waiting in the task_queue"""
+        return self._task_queue.qsize() if self._task_queue else 0
+
+
+    def get_queue_high_water (self):
+        """most tasks ever waiting in the task_queue, e.g., to size memory allocations"""
+        return self.queue_high_water
+
+
+    def _push_telemetry (self, telemetry_uri):
+        """periodically sample resource usage, pushing any noticeable changes to the Framework"""
+        sampler = TelemetrySampler(self.get_queue_depth, self.get_queue_high_water)
+        logging.info("pushing telemetry to %s", telemetry_uri)
+
+        while True:
+            sleep(sampler.sample_secs)
+            delta = sampler.get_delta()
+
+            if delta is not None:
+                t0 = get_cpu_secs()
+
+                try:
+                    post_distrib_rest(self.prefix, self.shard_id, telemetry_uri, "telemetry/push", { "delta": delta })
+                except Exception:
+                    # NB: telemetry is best effort; try again next time
+                    logging.warning("shard %s could not push telemetry to %s", self.shard_id, telemetry_uri)
+
+                sampler.account(get_cpu_secs() - t0)
+
+
     ######################################################################
     ## barrier pattern methods
 
@@ -149,16 +212,56 @@ class Worker (object):
             finally:
                 self._task_queue.task_done()
 
+            # NB: yield between tasks, so that REST requests get served
+            # even while the task_queue is backlogged
+            sleep(0)
+
 
-    def prep_task_queue (self):
-        """prepare task_queue for another set of distributed tasks"""
-        self._task_queue = JoinableQueue()
+    def prep_task_queue (self, maxsize=None):
+        """prepare task_queue for another set of distributed tasks, optionally bounded"""
+        self._task_queue = JoinableQueue(maxsize)
         spawn(self._consume_task_queue)
 
 
     def put_task_queue (self, payload):
-        """put the given task definition into the task_queue"""
-        self._task_queue.put_nowait(payload)
+        """put the given task definition into the task_queue; returns False if a bounded queue is full"""
+        try:
+            self._task_queue.put_nowait(payload)
+        except Full:
+            self.queue_rejects += 1
+            return False
+
+        self.queue_high_water = max(self.queue_high_water, self._task_queue.qsize())
+        return True
+
+
+    def reject_task (self, start_response, body):
+        """respond to a task which did not fit in the task_queue, asking the sender to retry later"""
+        start_response('503 Service Unavailable', [('Content-Type', 'text/plain'), ('Retry-After', str(int(ceil(self.RETRY_SECS))))])
+        body.put("Retry\t%s\r\n" % self.RETRY_SECS)
+        body.put(dumps(self.get_queue_depth()))
+        body.put("\r\n")
+        body.put(StopIteration)
+
+
+    def take_task_queue (self, n):
+        """take up to n tasks from the task_queue, e.g., to shed load onto another shard; each must get marked done later"""
+        tasks = []
+
+        while len(tasks) < n and not self._task_queue.empty():
+            tasks.append(self._task_queue.get_nowait())
+
+        return tasks
+
+
+    def done_task_queue (self):
+        """mark a task taken from the task_queue as done"""
+        self._task_queue.task_done()
+
+
+    def is_idle (self):
+        """test whether this shard has neither tasks to send nor queued tasks to perform"""
+        return self._task_event is None and self.get_queue_depth() == 0
 
 
     def queue_wait (self, *args, **kwargs):
@@ -188,7 +291,17 @@ class Worker (object):
             ## a long-polling HTTP request or websocket instead?
             self._task_queue.join()
 
-            body.put("done\r\n")
+            # NB: the high water mark spans the run, while the rejects
+            # count for this phase only
+            logging.info("shard %s queue high water %d rejected %d", self.shard_id, self.queue_high_water, self.queue_rejects)
+            self.queue_rejects = 0
+
+            # NB: respond with the shard's stats on completion, so the
+            # Framework needs no further round trip to read them
+            stats = self._uow.get_barrier_stats() if self._uow else None
+
+            body.put(dumps(stats))
+            body.put("\r\n")
             body.put(StopIteration)
 
 
@@ -201,12 +314,13 @@ class Worker (object):
 
         if self.auth_request(payload, start_response, body):
             self.ring = payload["ring"]
+            self.ring_weights = payload.get("weights")
 
             start_response('200 OK', [('Content-Type', 'text/plain')])
             body.put("Bokay\r\n")
             body.put(StopIteration)
 
-            logging.info("setting hash ring %s", self.ring)
+            logging.info("setting hash ring %s weights %s", self.ring, self.ring_weights)
 
 
     ######################################################################
@@ -244,6 +358,11 @@ class Worker (object):
             payload = loads(env["wsgi.input"].read())
             Greenlet(self.shard_stop, payload).start_later(1)
 
+            # NB: stop pushing telemetry right away, since the Framework
+            # is about to exit
+            if self._telemetry and (self.prefix == payload["prefix"]) and (self.shard_id == payload["shard_id"]):
+                self._telemetry.kill(block=False)
+
             # HTTP response starts first, to avoid error after server stops
             start_response('200 OK', [('Content-Type', 'text/plain')])
             body.put("Goodbye\r\n")
@@ -315,6 +434,11 @@ class WorkerInfo (object):
         self.ip_addr = None
         self.port = None
 
+        # capacity of the slave, from the resources in its offer
+        resources = dict([ (r.name, r.scalar.value) for r in offer.resources if r.name in ("cpus", "mem") ])
+        self.cpus = resources.get("cpus")
+        self.mem = resources.get("mem")
+
     def get_shard_uri (self):
         """generate a URI for this worker service"""
         return self.ip_addr + ":" + self.port
@@ -322,12 +446,19 @@ class WorkerInfo (object):
 
     def report (self):
         """report the slave telemetry + state"""
-        return "host %s slave %s task %s exe %s ip %s:%s" % (self.host, self.slave_id, str(self.task_id), self.executor_id, self.ip_addr, self.port)
+        return "host %s slave %s task %s exe %s ip %s:%s cpus %s mem %s" % (self.host, self.slave_id, str(self.task_id), self.executor_id, self.ip_addr, self.port, self.cpus, self.mem)
 
 
 class Framework (object):
-    def __init__ (self, uow_name, prefix="/tmp/exelixi"):
+    DEFAULT_PORT = "9310"
+
+
+    def __init__ (self, uow_name, prefix="/tmp/exelixi", port=DEFAULT_PORT):
         """initialize the system parameters, which represent operational state"""
+        # NB: cooperative sockets, so that REST calls to different
+        # shards can be in flight concurrently from Greenlets
+        monkey.patch_socket()
+
         self.uuid = uuid1().hex
         self.prefix = prefix + "/" + self.uuid
         logging.info("prefix: %s", self.prefix)
@@ -341,6 +472,12 @@ class Framework (object):
 
         self._shard_assoc = None
         self._ring = None
+        self.ring_weights = None
+
+        # REST service for telemetry pushed by the workers
+        self.port = port
+        self.server = None
+        self.telemetry = TelemetryView()
 
 
     def _gen_shard_id (self, i, n):
@@ -376,6 +513,39 @@ class Framework (object):
         return len(self._shard_assoc)
 
 
+    def get_ring_weights (self, capacity):
+        """weight each shard by the lesser of its shares of the total CPU and memory, given a dict of shard_id -> {cpus, mem}; returns None for an unweighted ring if neither resource got reported"""
+        totals = {}
+
+        for resource in [ "cpus", "mem" ]:
+            total = float(sum([ x[resource] for x in capacity.values() ]))
+
+            # NB: skip any resource which no shard reported
+            if total > 0.0:
+                totals[resource] = total
+
+        if not totals:
+            return None
+
+        return { shard_id: min([ x[resource] / totals[resource] * len(capacity) for resource in totals.keys() ]) for shard_id, x in capacity.items() }
+
+
+    def get_capacity (self, config_lines):
+        """capacity per shard: from the resource offers if available, otherwise from the host capacity each shard reported, split among the shards which share a host"""
+        capacity = {}
+
+        for shard_id, (shard_uri, exe_info) in self._shard_assoc.items():
+            if exe_info and exe_info.cpus and exe_info.mem:
+                capacity[shard_id] = { "cpus": exe_info.cpus, "mem": exe_info.mem }
+            else:
+                host = shard_uri.split(":")[0]
+                n_local = len([ uri for uri, exe in self._shard_assoc.values() if uri.split(":")[0] == host ])
+                reported = loads(config_lines[shard_id][-1])
+                capacity[shard_id] = { resource: reported[resource] / float(n_local) for resource in [ "cpus", "mem" ] }
+
+        return capacity
+
+
     def send_worker_rest (self, shard_id, shard_uri, path, base_msg):
         """access a REST endpoint on the specified shard"""
         return post_distrib_rest(self.prefix, shard_id, shard_uri, path, base_msg)
@@ -396,19 +566,99 @@ class Framework (object):
         """
         implements a two-phase barrier to (1) wait until all shards
         have finished sending task_queue requests, then (2) join on
-        each task_queue, to wait until it has emptied
+        each task_queue, to wait until it has emptied; returns the
+        stats from each shard at completion
         """
         self.send_ring_rest("queue/wait", {})
-        self.send_ring_rest("queue/join", {})
+        shard_stats = []
+
+        for shard_id, (shard_uri, exe_info) in self._shard_assoc.items():
+            # the last line of the join response holds the shard's stats
+            lines = post_distrib_rest(self.prefix, shard_id, shard_uri, "queue/join", {})
+            shard_stats.append(loads(lines[-1]))
+
+        return shard_stats
+
+
+    ######################################################################
+    ## telemetry methods
+
+    def start_telemetry (self):
+        """start the REST service which collects telemetry from the workers, returning its port (if any)"""
+        try:
+            self.server = wsgi.WSGIServer(('', int(self.port)), self._response_handler, log=None)
+            self.server.start()
+            logging.info("status endpoint: http://%s:%s/status", socket.gethostname(), self.port)
+            return self.port
+        except socket.error:
+            # NB: run without telemetry, rather than fail
+            logging.warning("could not listen on port %s for telemetry", self.port, exc_info=True)
+            self.server = None
+            return None
+
+
+    def get_shard_telemetry (self, shard_id):
+        """rolling view of the telemetry for a shard, e.g., for scheduling decisions"""
+        return self.telemetry.get_shard_view(shard_id)
+
+
+    def telemetry_push (self, *args, **kwargs):
+        """merge a telemetry delta pushed by a shard"""
+        env, start_response, body = args
+        payload = loads(env["wsgi.input"].read())
+
+        if (self.prefix == payload["prefix"]) and (payload["shard_id"] in self._shard_assoc):
+            self.telemetry.update(payload["shard_id"], payload["delta"])
+
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            body.put("Bokay\r\n")
+        else:
+            start_response('403 Forbidden', [('Content-Type', 'text/plain')])
+            body.put("Forbidden, incorrect credentials for this framework\r\n")
+
+            logging.error("incorrect credentials shard %s prefix %s", payload["shard_id"], payload["prefix"])
+
+        body.put(StopIteration)
+
+
+    def _response_handler (self, env, start_response):
+        """handle HTTP request/response"""
+        uri_path = env["PATH_INFO"]
+        body = JoinableQueue()
+
+        if uri_path == '/telemetry/push':
+            # merge a telemetry delta pushed by a shard
+            Greenlet(self.telemetry_push, env, start_response, body).start()
+
+        elif uri_path == '/status':
+            # report the rolling view of telemetry per shard
+            start_response('200 OK', [('Content-Type', 'application/json')])
+            body.put(dumps(self.telemetry.get_status(), indent=2) + "\r\n")
+            body.put(StopIteration)
+
+        else:
+            # ne znayu
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            body.put('Not Found\r\n')
+            body.put(StopIteration)
+
+        return body
 
 
     def orchestrate_uow (self):
         """orchestrate a UnitOfWork distributed across the HashRing via REST endpoints"""
         # configure the shards and the hash ring
-        self.send_ring_rest("shard/config", { "uow_name": self.uow_name })
+        telemetry_port = self.start_telemetry()
+        config_lines = {}
 
+        for shard_id, shard_uri in self.get_worker_list():
+            config_lines[shard_id] = self.send_worker_rest(shard_id, shard_uri, "shard/config", { "uow_name": self.uow_name, "telemetry_port": telemetry_port })
+
+        # NB: key ownership on the HashRing, and with it the work, is
+        # proportional to each shard's capacity
         self._ring = { shard_id: shard_uri for shard_id, (shard_uri, exe_info) in self._shard_assoc.items() }
-        self.send_ring_rest("ring/init", { "ring": self._ring })
+        self.ring_weights = self.get_ring_weights(self.get_capacity(config_lines))
+        self.send_ring_rest("ring/init", { "ring": self._ring, "weights": self.ring_weights })
 
         # distribute the UnitOfWork tasks
         self._uow.orchestrate(self)
@@ -416,8 +666,15 @@ class Framework (object):
         # shutdown
         self.send_ring_rest("shard/stop", {})
 
+        if self.server:
+            self.server.stop()
+
 
 class UnitOfWork (object):
+    ## NB: override to tune the virtual nodes per shard on the HashRing
+    RING_REPLICAS = 100
+
+
     def __init__ (self, uow_name, prefix):
         self.uow_name = uow_name
         self.uow_factory = instantiate_class(uow_name)
@@ -429,11 +686,11 @@ class UnitOfWork (object):
         self._hash_ring = None
 
 
-    def set_ring (self, shard_id, shard_dict):
-        """initialize the HashRing"""
+    def set_ring (self, shard_id, shard_dict, weights=None):
+        """initialize the HashRing, optionally weighted by the capacity of each shard"""
         self._shard_id = shard_id
         self._shard_dict = shard_dict
-        self._hash_ring = HashRing(shard_dict.keys())
+        self._hash_ring = HashRing(shard_dict.keys(), replicas=self.RING_REPLICAS, weights=weights)
 
 
     def perform_task (self, payload):
@@ -441,6 +698,11 @@ class UnitOfWork (object):
         pass
 
 
+    def get_barrier_stats (self):
+        """JSON-serializable stats for this shard, returned when a phase barrier completes"""
+        return None
+
+
     def orchestrate (self, framework):
         """orchestrate Workers via REST endpoints"""
         pass
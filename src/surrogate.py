@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# author: Paco Nathan
+# https://github.com/ceteri/exelixi
+
+
+from collections import Counter, deque
+from random import random
+import numpy as np
+import sys
+
+
+######################################################################
+## class definitions
+
+class Surrogate (object):
+    """cheap online model of a fitness function, k nearest neighbors over recently evaluated feature vectors, used to pre-screen offspring"""
+
+    def __init__ (self, rate, audit_rate, k=5, window=1000, min_samples=50):
+        # fraction of the candidates which get a real evaluation, plus
+        # the fraction of rejected candidates evaluated anyway, to
+        # measure how often rejections were correct
+        self.rate = rate
+        self.audit_rate = audit_rate
+
+        self.k = k
+        self.window = window
+        self.min_samples = min_samples
+
+        self._x = None
+        self._y = np.zeros(window)
+        self._n = 0
+
+        self._predictions = deque(maxlen=200)
+        self._stats = Counter()
+
+
+    def is_ready (self):
+        """test whether the model has seen enough evaluations to make predictions"""
+        return self._n >= self.min_samples
+
+
+    def predict (self, x):
+        """predict the fitness for a feature vector, as the distance-weighted mean of its k nearest neighbors"""
+        n = min(self._n, self.window)
+        dist = np.sqrt(((self._x[:n] - x) ** 2.0).sum(axis=1))
+        nearest = np.argpartition(dist, self.k - 1)[:self.k]
+        weight = 1.0 / (dist[nearest] + 1.0e-9)
+
+        return float((self._y[nearest] * weight).sum() / weight.sum())
+
+
+    def screen (self, x):
+        """decide whether a candidate merits a real evaluation; returns (accept, predicted fitness, audit)"""
+        if not self.is_ready():
+            return True, None, False
+
+        predicted = self.predict(x)
+        self._predictions.append(predicted)
+        self._stats["screened"] += 1
+
+        # NB: the threshold adapts to the recent predictions, so that
+        # the given fraction of candidates pass
+        threshold = np.percentile(self._predictions, 100.0 * (1.0 - self.rate))
+
+        if predicted >= threshold:
+            return True, predicted, False
+        elif random() < self.audit_rate:
+            self._stats["audited"] += 1
+            return True, predicted, True
+        else:
+            self._stats["saved"] += 1
+            return False, predicted, False
+
+
+    def learn (self, x, fitness, predicted, audit, fitness_cutoff):
+        """train the model on an evaluated candidate, and track the accuracy of its prediction"""
+        if self._x is None:
+            self._x = np.zeros((self.window, len(x)))
+
+        i = self._n % self.window
+        self._x[i] = x
+        self._y[i] = fitness
+        self._n += 1
+
+        if predicted is not None:
+            self._stats["evaluated"] += 1
+            self._stats["abs_error"] += abs(predicted - fitness)
+
+            if audit and fitness_cutoff is not None and fitness <= fitness_cutoff:
+                self._stats["correct_rejects"] += 1
+
+
+    def get_report (self):
+        """summarize then reset the stats: evaluations saved, mean absolute error, and fraction of audited rejections which were correct"""
+        stats = self._stats
+        self._stats = Counter()
+
+        mae = stats["abs_error"] / stats["evaluated"] if stats["evaluated"] else 0.0
+        correct = stats["correct_rejects"] / float(stats["audited"]) if stats["audited"] else 0.0
+
+        return stats["screened"], stats["saved"], mae, correct
+
+
+if __name__=='__main__':
+    # a simple test: learn a linear function of 5 features
+    model = Surrogate(0.5, 0.2)
+    weights = np.random.random_sample(5)
+
+    for _ in xrange(5000):
+        x = np.random.random_sample(5)
+        fitness = float(x.dot(weights) / weights.sum())
+        accept, predicted, audit = model.screen(x)
+
+        if accept:
+            model.learn(x, fitness, predicted, audit, 0.5)
+
+    print "screened %d saved %d mae %0.4f correct rejects %0.4f" % model.get_report()
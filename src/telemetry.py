@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# author: Paco Nathan
+# https://github.com/ceteri/exelixi
+
+
+from collections import deque
+from multiprocessing import cpu_count
+from time import time
+import os
+import psutil
+import sys
+
+
+######################################################################
+## globals
+
+# NB: psutil renamed these in later releases
+_net_io_counters = getattr(psutil, "net_io_counters", None) or getattr(psutil, "network_io_counters")
+
+
+######################################################################
+## utility functions
+
+def get_capacity ():
+    """capacity of this host: CPU count and total memory (bytes)"""
+    return { "cpus": cpu_count(), "mem": psutil.virtual_memory().total }
+
+
+def get_cpu_secs ():
+    """CPU time used by this process so far"""
+    t = os.times()
+    return t[0] + t[1]
+
+
+######################################################################
+## class definitions
+
+class TelemetrySampler (object):
+    """sample resource usage on a worker, reporting only the fields which changed noticeably since the last report"""
+
+    ## NB: override to tune how often to sample (seconds), how often to
+    ## report even when nothing changed, the relative change which
+    ## counts as noticeable, and the sampling budget as a fraction of
+    ## the worker's CPU
+    SAMPLE_SECS = 2.0
+    HEARTBEAT_SECS = 30.0
+    TOLERANCE = 0.1
+    MAX_OVERHEAD = 0.01
+
+
+    def __init__ (self, get_queue_depth, get_queue_high_water=None):
+        self._get_queue_depth = get_queue_depth
+        self._get_queue_high_water = get_queue_high_water
+        self.sample_secs = self.SAMPLE_SECS
+
+        self._reported = {}
+        self._last_report = 0.0
+        self._last_sample = None
+        self._started = time()
+        self._cost = 0.0
+
+        # NB: the first call only sets the baseline for the next one
+        psutil.cpu_percent(interval=None)
+
+
+    def sample (self):
+        """sample the current resource usage, as a dict of rounded values"""
+        now = time()
+        cpu_secs = get_cpu_secs()
+        net = _net_io_counters()
+
+        sample = {
+            "cpu": round(psutil.cpu_percent(interval=None), 1),
+            "mem": round(psutil.virtual_memory().percent, 1),
+            "queue": self._get_queue_depth(),
+            }
+
+        if self._get_queue_high_water:
+            sample["queue_max"] = self._get_queue_high_water()
+
+        if self._last_sample:
+            last_now, last_cpu_secs, last_net = self._last_sample
+            elapsed = max(now - last_now, 1.0e-6)
+
+            sample["proc_cpu"] = round(100.0 * (cpu_secs - last_cpu_secs) / elapsed, 1)
+            sample["net_tx"] = int((net.bytes_sent - last_net.bytes_sent) / elapsed)
+            sample["net_rx"] = int((net.bytes_recv - last_net.bytes_recv) / elapsed)
+            sample["overhead"] = round(100.0 * self.get_overhead(), 3)
+
+        self._last_sample = (now, cpu_secs, net)
+        return sample
+
+
+    def _is_changed (self, key, value):
+        """test whether a value differs noticeably from the one last reported"""
+        if key not in self._reported:
+            return True
+
+        last = self._reported[key]
+        return abs(value - last) > self.TOLERANCE * max(abs(last), 1.0)
+
+
+    def get_delta (self):
+        """take a sample, returning the changed fields to report, an empty dict as a heartbeat, or None if there's nothing to report"""
+        t0 = get_cpu_secs()
+        sample = self.sample()
+        now = time()
+
+        delta = { k: v for k, v in sample.items() if self._is_changed(k, v) }
+
+        if not delta and now - self._last_report < self.HEARTBEAT_SECS:
+            delta = None
+        else:
+            self._reported.update(delta)
+            self._last_report = now
+
+        self.account(get_cpu_secs() - t0)
+        return delta
+
+
+    def get_overhead (self):
+        """CPU time spent on sampling and reporting, as a fraction of the elapsed time"""
+        return self._cost / max(time() - self._started, self.SAMPLE_SECS)
+
+
+    def account (self, cost):
+        """add to the CPU cost of sampling and reporting, then back off if the sampling exceeds its budget"""
+        self._cost += cost
+
+        if self.get_overhead() > self.MAX_OVERHEAD:
+            self.sample_secs *= 2.0
+            self._started = time()
+            self._cost = 0.0
+
+
+class TelemetryView (object):
+    """rolling view of the telemetry reported by each shard"""
+
+    ## NB: override to tune how many reports per shard get kept
+    WINDOW = 30
+
+
+    def __init__ (self):
+        self._current = {}
+        self._history = {}
+        self._updated = {}
+
+
+    def update (self, shard_id, delta):
+        """merge a shard's reported delta into its current view"""
+        if shard_id not in self._current:
+            self._current[shard_id] = {}
+            self._history[shard_id] = deque(maxlen=self.WINDOW)
+
+        current = self._current[shard_id]
+        current.update(delta)
+
+        self._history[shard_id].append(current.copy())
+        self._updated[shard_id] = time()
+
+
+    def get_mean (self, shard_id, key, default=None):
+        """mean of a field over the shard's recent reports"""
+        values = [ x[key] for x in self._history.get(shard_id, []) if key in x ]
+
+        if not values:
+            return default
+        else:
+            return sum(values) / float(len(values))
+
+
+    def get_shard_view (self, shard_id):
+        """current values for a shard, plus their means over the window and the age of the view"""
+        current = self._current.get(shard_id, {})
+
+        return {
+            "current": current,
+            "mean": { key: round(self.get_mean(shard_id, key), 3) for key in current.keys() },
+            "age": round(time() - self._updated[shard_id], 1) if shard_id in self._updated else None,
+            }
+
+
+    def get_status (self):
+        """view of all the shards, e.g., for a status endpoint"""
+        return { shard_id: self.get_shard_view(shard_id) for shard_id in sorted(self._current.keys()) }
+
+
+if __name__=='__main__':
+    ## measure the sampling overhead, then exercise the rolling view
+    from json import dumps
+    from time import sleep
+
+    sampler = TelemetrySampler(lambda: 0)
+    view = TelemetryView()
+    n = 1000
+
+    cpu0 = get_cpu_secs()
+
+    for _ in xrange(n):
+        sampler.sample()
+
+    cost = (get_cpu_secs() - cpu0) / n
+    print "%0.3f ms CPU per sample, i.e., %0.4f%% overhead at %0.1f sec intervals" % (1000.0 * cost, 100.0 * cost / TelemetrySampler.SAMPLE_SECS, TelemetrySampler.SAMPLE_SECS)
+
+    for _ in xrange(5):
+        sleep(0.2)
+        delta = sampler.get_delta()
+
+        if delta is not None:
+            view.update("shard/0", delta)
+
+    print dumps(view.get_status(), indent=2)
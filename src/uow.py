@@ -21,6 +21,7 @@ from ga import Individual, Population
 from random import randint
 from util import instantiate_class
 import logging
+import numpy as np
 
 
 ######################################################################
@@ -29,6 +30,46 @@ import logging
 class UnitOfWorkFactory (object):
     """encapsulates all of the dependency injection and UnitOfWork definitions"""
 
+    ## NB: override these to pre-screen offspring with a surrogate model
+    ## before an expensive fitness evaluation: the fraction of offspring
+    ## to evaluate, and the fraction of rejected offspring to evaluate
+    ## anyway, to measure the accuracy of rejections
+    surrogate_rate = None
+    surrogate_audit = 0.1
+
+    ## NB: override to write the final Population into a compressed
+    ## columnar file, instead of printing it to stdout
+    results_file = None
+
+    ## NB: override to let a shard with a backlog of queued fitness
+    ## evaluations shed some of them onto idle peers
+    load_shedding = False
+
+    ## NB: override to bound the task_queue on each shard, which limits
+    ## its memory use; then when a shard's queue is full, its senders
+    ## either "backoff" and retry, or "buffer" the births locally and
+    ## deliver them at the end of the generation
+    task_queue_limit = None
+    flow_control = "backoff"
+
+    ## NB: override to separate the dedup check from data placement:
+    ## each shard sends only batches of key digests to their owner
+    ## shards for a test-and-set, then keeps and evaluates the accepted
+    ## offspring locally
+    digest_dedup = False
+
+    ## NB: override to have shards periodically publish Bloom filter
+    ## summaries of their dedup registries, so that senders skip births
+    ## which are almost certainly duplicates; the owner shards still
+    ## dedup exactly
+    bloom_prefilter = False
+
+    ## NB: override to bound the memory (bytes) which each shard uses to
+    ## dedup the keys of all the Individuals ever reified, letting the
+    ## oldest keys expire, so that some duplicates get rediscovered and
+    ## evaluated again
+    dedup_memory = None
+
     def __init__ (self):
         ## NB: override these GA parameters
         self.n_pop = 23
@@ -58,6 +99,28 @@ class UnitOfWorkFactory (object):
         return 1.0 - abs(sum(feature_set) - self.target) / float(self.target)
 
 
+    def get_fitness_state (self, feature_set):
+        """determine the fitness, plus any state which get_fitness_delta needs in order to evaluate children incrementally"""
+        ## NB: override along with get_fitness_delta
+        return self.get_fitness(feature_set), None
+
+
+    def get_fitness_delta (self, feature_set, parent_states, delta):
+        """determine the (fitness, state) of a child from the states of its parents plus a description of the change; None to evaluate it in full"""
+        ## NB: override for incremental fitness evaluation; the delta
+        ## comes from mutate_features_delta, or is None for a child bred
+        ## from two parents
+        return None
+
+
+    def get_surrogate_features (self, feature_set):
+        """convert a feature set into a fixed-length numeric vector for the surrogate model"""
+        ## NB: override this when distances between feature sets need
+        ## a different representation
+        vector = [ float(x) for x in feature_set[:self.length] ]
+        return vector + [ 0.0 ] * (self.length - len(vector))
+
+
     def use_force (self, force):
         """determine whether to force recalculation of a fitness function"""
         # NB: override in some use cases, e.g., when required for evaluating shared resources
@@ -79,6 +142,12 @@ class UnitOfWorkFactory (object):
         return sorted(mutated_feature_set)
 
 
+    def mutate_features_delta (self, feature_set):
+        """mutate a copy of the given feature set, also describing the change for get_fitness_delta"""
+        ## NB: override along with get_fitness_delta
+        return self.mutate_features(feature_set), None
+
+
     def breed_features (self, f_feature_set, m_feature_set):
         """breed two feature sets to produce a child"""
         ## NB: override this feature set crossover
@@ -86,6 +155,50 @@ class UnitOfWorkFactory (object):
         return sorted(f_feature_set[half:] + m_feature_set[:half])
 
 
+    ######################################################################
+    ## batch variants of the feature set operators, to produce many
+    ## feature sets per call from NumPy RNG draws
+
+    def _is_overridden (self, *method_names):
+        """test whether a subclass overrides any of the given per-call methods, so their batch variants must fall back to them"""
+        return any([ getattr(self.__class__, name).im_func is not getattr(UnitOfWorkFactory, name).im_func for name in method_names ])
+
+
+    def generate_features_batch (self, k):
+        """generate k new feature sets"""
+        ## NB: override along with generate_features
+        if self._is_overridden("generate_features"):
+            return [ self.generate_features() for _ in xrange(k) ]
+
+        features = np.random.randint(self.min, self.max + 1, size=(k, self.length))
+        return np.sort(features, axis=1).tolist()
+
+
+    def mutate_features_batch (self, feature_sets):
+        """mutate copies of the given feature sets, returning a list of (feature set, delta) as per mutate_features_delta"""
+        ## NB: override along with mutate_features_delta
+        if self._is_overridden("mutate_features", "mutate_features_delta") or len(feature_sets) == 0:
+            return [ self.mutate_features_delta(feature_set) for feature_set in feature_sets ]
+
+        features = np.array(feature_sets)
+        rows = np.arange(len(features))
+        pos_to_mutate = np.random.randint(0, features.shape[1], size=len(features))
+        features[rows, pos_to_mutate] = np.random.randint(self.min, self.max + 1, size=len(features))
+        return [ (feature_set, None) for feature_set in np.sort(features, axis=1).tolist() ]
+
+
+    def breed_features_batch (self, couples):
+        """breed a list of (f_feature_set, m_feature_set) couples, producing one child per couple"""
+        ## NB: override along with breed_features
+        if self._is_overridden("breed_features") or len(couples) == 0:
+            return [ self.breed_features(f_feature_set, m_feature_set) for f_feature_set, m_feature_set in couples ]
+
+        f_features = np.array([ f_feature_set for f_feature_set, m_feature_set in couples ])
+        m_features = np.array([ m_feature_set for f_feature_set, m_feature_set in couples ])
+        half = f_features.shape[1] / 2
+        return np.sort(np.hstack((f_features[:, half:], m_features[:, :half])), axis=1).tolist()
+
+
     def _calc_median_hist (self, hist_items, n_indiv):
         """calculate the median from a fitness histogram"""
         sum_count = 0
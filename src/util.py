@@ -18,15 +18,32 @@
 
 
 from collections import OrderedDict
+from cStringIO import StringIO
+from gzip import GzipFile
+from hashlib import sha224
 from httplib import BadStatusLine
 from importlib import import_module
 from json import dumps, loads
-from os.path import abspath
+from logs import Lazy
+from os.path import abspath, basename, dirname, exists, getmtime, getsize, join, relpath, samefile
 from random import random
-from urllib2 import urlopen, Request, URLError
+from urllib2 import urlopen, HTTPError, Request, URLError
 import logging
+import os
 import psutil
+import shutil
 import socket
+import subprocess
+import tarfile
+
+
+######################################################################
+## globals
+
+BUNDLE_DIRS = ( "bin", "src", "dat" )
+BUNDLE_CACHE = "/tmp/exelixi/cache"
+BUNDLE_LAUNCHER = "launch_bundle.sh"
+BUNDLE_STAGING = "/tmp/exelixi/bundle"
 
 
 ######################################################################
@@ -39,7 +56,7 @@ def instantiate_class (class_path):
 
 
 def post_distrib_rest (prefix, shard_id, shard_uri, path, base_msg):
-    """POST a JSON-based message to a REST endpoint on a shard"""
+    """POST a JSON-based message to a REST endpoint on a shard; returns the response lines, including for a 503 response, where the shard asks the caller to retry later"""
     msg = base_msg.copy()
 
     # populate credentials
@@ -52,12 +69,19 @@ def post_distrib_rest (prefix, shard_id, shard_uri, path, base_msg):
     req.add_header('Content-Type', 'application/json')
 
     logging.debug("send %s %s", shard_uri, path)
-    logging.debug(dumps(msg))
+    logging.debug("%s", Lazy(dumps, msg))
 
     # read/collect the response
     try:
         f = urlopen(req, dumps(msg))
         return f.readlines()
+    except HTTPError as e:
+        if e.code == 503:
+            # NB: the shard is applying backpressure
+            return e.readlines()
+
+        logging.critical("could not reach REST endpoint %s error: %s", uri, str(e.reason), exc_info=True)
+        raise
     except URLError as e:
         logging.critical("could not reach REST endpoint %s error: %s", uri, str(e.reason), exc_info=True)
         raise
@@ -90,6 +114,104 @@ def get_telemetry ():
     return telemetry
 
 
+def build_bundle (uow_name):
+    """build a reproducible tarball of the Exelixi source plus the UnitOfWork module, returning its digest + contents"""
+    base_dir = dirname(dirname(abspath(__file__)))
+    members = {}
+
+    for sub_dir in BUNDLE_DIRS:
+        for root, dirs, files in os.walk(join(base_dir, sub_dir)):
+            for file_name in files:
+                if not file_name.endswith((".pyc", ".log")):
+                    path = join(root, file_name)
+                    members[relpath(path, base_dir)] = path
+
+    # the custom UnitOfWork module may live outside of the source tree
+    module_path = abspath(import_module(uow_name.split(".")[0]).__file__)
+
+    if module_path.endswith(".pyc"):
+        module_path = module_path[:-1]
+
+    members[join("src", basename(module_path))] = module_path
+
+    # NB: zero out timestamps and ownership, so that the same source
+    # always produces the same bytes, and therefore the same digest
+    buf = StringIO()
+    gz = GzipFile(filename="", mode="wb", fileobj=buf, mtime=0)
+    tar = tarfile.open(fileobj=gz, mode="w")
+
+    for arc_name in sorted(members.keys()):
+        info = tar.gettarinfo(members[arc_name], arc_name)
+        info.mtime = 0
+        info.uid = info.gid = 0
+        info.uname = info.gname = ""
+
+        with open(members[arc_name], "rb") as f:
+            tar.addfile(info, f)
+
+    tar.close()
+    gz.close()
+
+    data = buf.getvalue()
+    return sha224(data).hexdigest(), data
+
+
+def publish_bundle (bundle_uri, uow_name):
+    """publish the job bundle and its launcher to a file:// or hdfs:// URI, returning the digest + URIs"""
+    if not bundle_uri.startswith(("file://", "hdfs://")):
+        raise ValueError("Unsupported bundle URI: %s" % bundle_uri)
+
+    digest, data = build_bundle(uow_name)
+    bundle_name = "exelixi-" + digest + ".tgz"
+    launcher_path = join(dirname(dirname(abspath(__file__))), "bin", BUNDLE_LAUNCHER)
+
+    if bundle_uri.startswith("file://"):
+        local_dir = bundle_uri[len("file://"):]
+    else:
+        local_dir = BUNDLE_STAGING
+
+    if not exists(local_dir):
+        os.makedirs(local_dir)
+
+    # content-addressed, so an existing bundle never needs to be rewritten
+    local_path = join(local_dir, bundle_name)
+
+    if not exists(local_path):
+        with open(local_path, "wb") as f:
+            f.write(data)
+
+    if bundle_uri.startswith("file://"):
+        local_launcher = join(local_dir, BUNDLE_LAUNCHER)
+
+        # NB: the URI may point at the launcher's own directory
+        if not (exists(local_launcher) and samefile(launcher_path, local_launcher)):
+            shutil.copy(launcher_path, local_launcher)
+    else:
+        subprocess.call([ "hadoop", "fs", "-mkdir", "-p", bundle_uri ])
+
+        if subprocess.call([ "hadoop", "fs", "-test", "-e", bundle_uri + "/" + bundle_name ]) != 0:
+            subprocess.check_call([ "hadoop", "fs", "-put", local_path, bundle_uri + "/" + bundle_name ])
+
+        subprocess.check_call([ "hadoop", "fs", "-put", "-f", launcher_path, bundle_uri + "/" + BUNDLE_LAUNCHER ])
+
+    logging.info("published bundle %s to %s", digest, bundle_uri)
+    return digest, bundle_uri + "/" + bundle_name, bundle_uri + "/" + BUNDLE_LAUNCHER
+
+
+def get_bundle_exe_path (digest):
+    """path to the Exelixi executable, once a bundle has been unpacked into the cache on a slave"""
+    return join(BUNDLE_CACHE, digest, "src", "exelixi.py")
+
+
+def get_file_fingerprint (file_name):
+    """identify one version of a file, based on its path, size and mtime"""
+    file_name = abspath(file_name)
+
+    m = sha224()
+    m.update(dumps([ file_name, getsize(file_name), getmtime(file_name) ]))
+    return m.hexdigest()
+
+
 def get_master_state (master_uri):
     """get current state, represented as JSON, from the Mesos master"""
     uri = "http://" + master_uri + "/master/state.json"